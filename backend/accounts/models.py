@@ -4,9 +4,11 @@ Models for the accounts app.
 
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db.models.signals import post_init, post_save, pre_save, pre_delete
 from django.dispatch import receiver
 
+from jobs.queue import enqueue_on_commit
+
 
 def profile_picture_path(instance, filename):
     """Generate upload path for profile pictures."""
@@ -34,6 +36,19 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or 'profile_picture' in fields:
+            self._stored_picture_name = _loaded_picture_name(self)
+
+
+def _loaded_picture_name(instance):
+    """Name of the picture an instance was loaded with, or None if the field was deferred."""
+    if 'profile_picture' not in instance.__dict__:
+        return None
+    value = instance.__dict__['profile_picture']
+    return getattr(value, 'name', value) or ''
+
 
 # Signal to create UserProfile when User is created
 @receiver(post_save, sender=User)
@@ -48,27 +63,37 @@ def save_user_profile(sender, instance, **kwargs):
         instance.profile.save()
 
 
+# Signal to remember the stored picture, so saves can detect a new one without a query
+@receiver(post_init, sender=UserProfile)
+def remember_profile_picture(sender, instance, **kwargs):
+    instance._stored_picture_name = _loaded_picture_name(instance)
+
+
 # Signal to delete old profile picture when a new one is uploaded
 @receiver(pre_save, sender=UserProfile)
-def delete_old_profile_picture(sender, instance, **kwargs):
+def delete_old_profile_picture(sender, instance, update_fields=None, **kwargs):
     if not instance.pk:
         return  # New instance, no old file to delete
-
-    try:
-        old_instance = UserProfile.objects.get(pk=instance.pk)
-    except UserProfile.DoesNotExist:
+    if update_fields is not None and 'profile_picture' not in update_fields:
         return
 
-    old_file = old_instance.profile_picture
-    new_file = instance.profile_picture
+    old_name = instance._stored_picture_name
+    if old_name is None:
+        # Loaded with the picture deferred
+        old_name = UserProfile.objects.filter(pk=instance.pk).values_list('profile_picture', flat=True).first()
+
+    # If there was an old file and it's different from the new one, delete it after commit
+    if old_name and old_name != instance.profile_picture.name:
+        enqueue_on_commit('jobs.delete_files', names=[old_name])
+
 
-    # If there was an old file and it's different from the new one, delete it
-    if old_file and old_file != new_file:
-        old_file.delete(save=False)
+@receiver(post_save, sender=UserProfile)
+def remember_saved_profile_picture(sender, instance, **kwargs):
+    instance._stored_picture_name = instance.profile_picture.name or ''
 
 
 # Signal to delete profile picture when profile is deleted
 @receiver(pre_delete, sender=UserProfile)
 def delete_profile_picture_on_delete(sender, instance, **kwargs):
     if instance.profile_picture:
-        instance.profile_picture.delete(save=False)
\ No newline at end of file
+        enqueue_on_commit('jobs.delete_files', names=[instance.profile_picture.name])
\ No newline at end of file
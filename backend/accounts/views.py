@@ -168,10 +168,7 @@ class ProfilePictureView(APIView):
         serializer = ProfilePictureSerializer(profile, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
 
-        # Delete old picture if exists
-        if profile.profile_picture:
-            profile.profile_picture.delete(save=False)
-
+        # The old picture is deleted in the background by the pre_save signal
         serializer.save()
         return Response({
             'message': 'Profile picture updated successfully.',
@@ -181,7 +178,9 @@ class ProfilePictureView(APIView):
     def delete(self, request):
         profile = request.user.profile
         if profile.profile_picture:
-            profile.profile_picture.delete(save=True)
+            # The file is deleted in the background by the pre_save signal
+            profile.profile_picture = None
+            profile.save()
             return Response({'message': 'Profile picture deleted successfully.'}, status=status.HTTP_200_OK)
         return Response({'message': 'No profile picture to delete.'}, status=status.HTTP_404_NOT_FOUND)
 
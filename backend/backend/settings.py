@@ -32,6 +32,7 @@ INSTALLED_APPS = [
     # 'requests',
     # Local apps
     'accounts',
+    'jobs',
     'maps',
 ]
 
@@ -78,6 +79,17 @@ DATABASES = {
     }
 }
 
+# Cache shared by every gunicorn and runworker process, so cluster deltas
+# and POI caches written by one are seen by all. Create the table with
+# `python manage.py createcachetable` after migrating
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},  # Cluster levels, deltas and POI tiles of many maps
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -117,6 +129,11 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Protected media offload for /api/maps/media/: '' serves files from Django,
+# 'x-accel-redirect' hands them to nginx, 'x-sendfile' to Apache or lighttpd
+MEDIA_OFFLOAD = os.environ.get('MEDIA_OFFLOAD', '')
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # CORS settings - allows frontend connection
@@ -144,6 +161,7 @@ CORS_ALLOW_HEADERS = [
     "dnt",
     "origin",
     "user-agent",
+    "x-chunk-sha256",
     "x-csrftoken",
     "x-requested-with",
 ]
@@ -163,4 +181,38 @@ REST_FRAMEWORK = {
 
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 100 MB
-DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 100 MB
\ No newline at end of file
+DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 100 MB
+
+# Upload handlers hash files as they stream in, for content-addressed map storage
+FILE_UPLOAD_HANDLERS = [
+    'maps.storage.HashingMemoryFileUploadHandler',
+    'maps.storage.HashingTemporaryFileUploadHandler',
+]
+
+# Resumable chunked uploads (kept under MEDIA_ROOT so assembled files are moved, not copied)
+CHUNKED_UPLOAD_ROOT = MEDIA_ROOT / 'chunked_uploads'
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB default chunk
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MB
+CHUNKED_UPLOAD_MAX_SIZE = 4 * 1024 * 1024 * 1024  # 4 GB
+CHUNKED_UPLOAD_EXPIRY = 7 * 24 * 60 * 60  # Seconds an upload may sit idle before gc_media deletes it
+
+# Map image processing
+# Largest map image Pillow will open. Tile building decodes the whole image,
+# needing about 5 bytes per pixel: 8 GB for the worker at this limit
+MAP_IMAGE_MAX_PIXELS = 40000 * 40000
+MAP_DISPLAY_WEBP_QUALITY = 80  # Quality of the WebP display copy of map images
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', 2))  # Processes per web worker
+PDF_RENDER_TIMEOUT = 120  # Seconds to wait for a single page render
+
+# POI changes feed (/api/maps/maps/{id}/changes/)
+MAP_TOMBSTONE_RETENTION_DAYS = 30  # Changes feed cursors older than this get the full state again
+
+# Background jobs (python manage.py runworker)
+JOBS_WORKER_PROCESSES = int(os.environ.get('JOBS_WORKER_PROCESSES', 2))
+JOBS_RUN_INLINE = os.environ.get('JOBS_RUN_INLINE', 'False').lower() == 'true'  # Run jobs in the web process after commit
+JOBS_POLL_INTERVAL = 1  # Seconds between polls of an empty queue
+JOBS_LOCK_TIMEOUT = 30 * 60  # Seconds before a job left running by a dead worker is retried
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_BACKOFF = 10  # Seconds before the first retry, doubled on every attempt
+JOBS_RETRY_BACKOFF_MAX = 60 * 60
+JOBS_RETENTION_DAYS = 7  # Succeeded jobs are purged after this many days
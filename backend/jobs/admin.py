@@ -0,0 +1,14 @@
+"""
+Admin configuration for jobs app.
+"""
+
+from django.contrib import admin
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'attempts', 'run_after', 'content_type', 'object_id', 'created_at']
+    list_filter = ['status', 'name', 'created_at']
+    search_fields = ['name', 'last_error']
+    readonly_fields = ['created_at', 'updated_at', 'locked_at']
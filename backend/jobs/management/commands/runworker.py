@@ -0,0 +1,104 @@
+"""
+Run background jobs from the Job table.
+Usage: python manage.py runworker [--processes N] [--burst]
+"""
+
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from jobs.queue import claim_next_job, purge_finished_jobs, run_job
+
+
+class Worker:
+    """Polls the queue and runs jobs until stopped."""
+
+    def __init__(self, poll_interval, burst):
+        self.poll_interval = poll_interval
+        self.burst = burst
+        self.stopping = False
+
+    def stop(self, *args):
+        # Finish the current job, then exit
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        idle_since = None
+        while not self.stopping:
+            job = claim_next_job()
+            if job is not None:
+                run_job(job)
+                idle_since = None
+                continue
+
+            if self.burst:
+                return
+            if idle_since is None:
+                idle_since = time.monotonic()
+                purge_finished_jobs()
+            time.sleep(self.poll_interval)
+
+
+def _run_worker_process(poll_interval, burst):
+    Worker(poll_interval, burst).run()
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs (thumbnails, tiles, PDF pages, file cleanup) in a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=settings.JOBS_WORKER_PROCESSES,
+            help='Number of worker processes (default: JOBS_WORKER_PROCESSES).'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.JOBS_POLL_INTERVAL,
+            help='Seconds to wait between polls when the queue is empty.'
+        )
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            help='Exit once the queue is empty instead of waiting for new jobs.'
+        )
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        self.stdout.write(f'Starting {processes} worker process(es).')
+
+        if processes == 1:
+            _run_worker_process(options['poll_interval'], options['burst'])
+            return
+
+        # Children must open their own database connections. They are not
+        # daemonic, so tasks can still use process pools of their own.
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(
+                target=_run_worker_process,
+                args=(options['poll_interval'], options['burst'])
+            )
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+        def forward_stop(*args):
+            for worker in workers:
+                worker.terminate()  # Sends SIGTERM, handled by Worker.stop
+
+        signal.signal(signal.SIGTERM, forward_stop)
+        signal.signal(signal.SIGINT, forward_stop)
+        for worker in workers:
+            worker.join()
+        self.stdout.write(self.style.SUCCESS('Workers stopped.'))
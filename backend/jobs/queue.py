@@ -0,0 +1,171 @@
+"""
+Durable background job queue backed by the Job table.
+Tasks are plain functions registered with @task and called with the
+job payload as keyword arguments.
+"""
+
+import logging
+import threading
+import traceback
+import weakref
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(name):
+    """Register a function as the task run for jobs called name."""
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(task_name, target=None, **payload):
+    """
+    Queue a job. The row is written in the caller's transaction, so a
+    worker only sees it once that transaction commits.
+    With JOBS_RUN_INLINE the job runs right after commit instead.
+    """
+    job = Job(name=task_name, payload=payload, max_attempts=settings.JOBS_MAX_ATTEMPTS)
+    if target is not None:
+        job.content_type = ContentType.objects.get_for_model(target)
+        job.object_id = target.pk
+    job.save()
+
+    if settings.JOBS_RUN_INLINE:
+        transaction.on_commit(lambda: run_job(job))
+    return job
+
+
+# Batches waiting for commit, per thread and database alias. Only Django's
+# commit callbacks hold them strongly: a rollback discards the callbacks
+# and so drops the batches from here too. That relies on CPython freeing
+# them by reference counting the moment the callbacks go; an interpreter
+# that collects later could add a call to a batch that was already dropped
+_pending = threading.local()
+
+
+def _pending_batches(alias):
+    batches = getattr(_pending, 'batches', None)
+    if batches is None:
+        batches = _pending.batches = {}
+    return batches.setdefault(alias, weakref.WeakValueDictionary())
+
+
+class _JobBatch:
+    """Payload lists collected for one task until the transaction commits."""
+
+    def __init__(self, task_name, alias, key):
+        self.task_name = task_name
+        self.alias = alias
+        self.key = key
+        self.payload = {}
+
+    def __call__(self):
+        batches = _pending_batches(self.alias)
+        if batches.get(self.key) is self:
+            del batches[self.key]
+        enqueue(self.task_name, **self.payload)
+
+
+def enqueue_on_commit(task_name, using=None, **items):
+    """
+    Queue a job once the current transaction commits, merged with every
+    other call for the same task in that transaction. Each keyword is a
+    list that later calls extend, so deleting many objects queues one job.
+    Nothing is queued if the transaction, or the savepoint the call was
+    made in, rolls back.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        enqueue(task_name, **items)
+        return
+
+    # One batch per task and savepoint, as rolling a savepoint back only
+    # discards the callbacks registered inside it. Django has no public API
+    # for the open savepoints, so this reads the same private savepoint_ids
+    # that on_commit itself records with each callback
+    key = (task_name, frozenset(connection.savepoint_ids))
+    batches = _pending_batches(connection.alias)
+    batch = batches.get(key)
+    if batch is None:
+        batch = batches[key] = _JobBatch(task_name, connection.alias, key)
+        transaction.on_commit(batch, using=using)
+
+    for name, values in items.items():
+        batch.payload.setdefault(name, []).extend(values)
+
+
+def jobs_for(target):
+    """Jobs queued for an object, newest first."""
+    return Job.objects.filter(
+        content_type=ContentType.objects.get_for_model(target),
+        object_id=target.pk
+    )
+
+
+def claim_next_job():
+    """
+    Lock and mark running the next due job, or return None.
+    SKIP LOCKED lets many workers poll the table without blocking each
+    other; jobs left running by a crashed worker are picked up again once
+    their lock expires.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.JOBS_LOCK_TIMEOUT)
+    with transaction.atomic():
+        job = (
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='queued', run_after__lte=now) | Q(status='running', locked_at__lt=stale))
+            .order_by('run_after', 'id')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = 'running'
+        job.locked_at = now
+        job.save(update_fields=['status', 'locked_at', 'updated_at'])
+    return job
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome, scheduling a retry on failure."""
+    job.attempts += 1
+    func = TASKS.get(job.name)
+    try:
+        if func is None:
+            raise LookupError(f'No task registered as {job.name!r}.')
+        func(**job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            logger.error('Job %s failed after %s attempts', job, job.attempts)
+        else:
+            delay = min(settings.JOBS_RETRY_BACKOFF * 2 ** (job.attempts - 1), settings.JOBS_RETRY_BACKOFF_MAX)
+            job.status = 'queued'
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+            logger.warning('Job %s failed, retrying in %ss', job, delay)
+    else:
+        job.status = 'succeeded'
+        job.last_error = ''
+
+    job.locked_at = None
+    job.save(update_fields=['status', 'attempts', 'run_after', 'locked_at', 'last_error', 'updated_at'])
+
+
+def purge_finished_jobs():
+    """Delete succeeded jobs older than JOBS_RETENTION_DAYS."""
+    cutoff = timezone.now() - timedelta(days=settings.JOBS_RETENTION_DAYS)
+    Job.objects.filter(status='succeeded', updated_at__lt=cutoff).delete()
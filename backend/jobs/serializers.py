@@ -0,0 +1,18 @@
+"""
+Serializers for the jobs app.
+"""
+
+from rest_framework import serializers
+from .models import Job
+
+
+class JobSerializer(serializers.ModelSerializer):
+    """
+    Read-only serializer reporting the progress of a background job.
+    Tracebacks stay in the admin, as anyone who can view a map sees its jobs.
+    """
+
+    class Meta:
+        model = Job
+        fields = ['id', 'name', 'status', 'attempts', 'created_at', 'updated_at']
+        read_only_fields = fields
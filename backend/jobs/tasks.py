@@ -0,0 +1,14 @@
+"""
+Generic background tasks shared by every app.
+"""
+
+from django.core.files.storage import default_storage
+
+from .queue import task
+
+
+@task('jobs.delete_files')
+def delete_files(names):
+    """Delete files from default storage."""
+    for name in names:
+        default_storage.delete(name)
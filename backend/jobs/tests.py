@@ -0,0 +1,48 @@
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+
+from .models import Job
+from .queue import enqueue_on_commit
+
+TASK = 'tests.collect'
+
+
+@override_settings(JOBS_RUN_INLINE=False)
+class EnqueueOnCommitTests(TransactionTestCase):
+    """Calls in one transaction queue one job, and nothing survives a rollback."""
+
+    def payloads(self):
+        return [job.payload for job in Job.objects.filter(name=TASK).order_by('id')]
+
+    def test_outside_a_transaction(self):
+        enqueue_on_commit(TASK, names=['a'])
+        self.assertEqual(self.payloads(), [{'names': ['a']}])
+
+    def test_calls_are_merged(self):
+        with transaction.atomic():
+            enqueue_on_commit(TASK, names=['a'])
+            enqueue_on_commit(TASK, names=['b', 'c'])
+            enqueue_on_commit('tests.other', names=['x'])
+            self.assertEqual(self.payloads(), [])
+        self.assertEqual(self.payloads(), [{'names': ['a', 'b', 'c']}])
+
+    def test_rolled_back_transaction(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                enqueue_on_commit(TASK, names=['a'])
+                raise ValueError
+        with transaction.atomic():
+            enqueue_on_commit(TASK, names=['b'])
+        self.assertEqual(self.payloads(), [{'names': ['b']}])
+
+    def test_rolled_back_savepoint(self):
+        with transaction.atomic():
+            enqueue_on_commit(TASK, names=['a'])
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    enqueue_on_commit(TASK, names=['b'])
+                    raise ValueError
+            with transaction.atomic():
+                enqueue_on_commit(TASK, names=['c'])
+            enqueue_on_commit(TASK, names=['d'])
+        self.assertEqual(sorted(names for payload in self.payloads() for names in payload['names']), ['a', 'c', 'd'])
@@ -3,7 +3,7 @@ Admin configuration for maps app.
 """
 
 from django.contrib import admin
-from .models import Map, MapLayer, PointOfInterest, SharedMap
+from .models import Map, MapFileBlob, MapLayer, PointOfInterest, SharedMap, ChunkedUpload, delete_pois
 
 
 class MapLayerInline(admin.TabularInline):
@@ -48,10 +48,29 @@ class PointOfInterestAdmin(admin.ModelAdmin):
     search_fields = ['name', 'description', 'map__name', 'layer__name']
     readonly_fields = ['created_at', 'updated_at']
 
+    def delete_queryset(self, request, queryset):
+        # Bulk deletes skip PointOfInterest.delete(), which records them
+        delete_pois(queryset)
+
 
 @admin.register(SharedMap)
 class SharedMapAdmin(admin.ModelAdmin):
     list_display = ['map', 'shared_with', 'shared_by', 'permission', 'created_at']
     list_filter = ['permission', 'created_at']
     search_fields = ['map__name', 'shared_with__username', 'shared_by__username']
-    readonly_fields = ['created_at', 'updated_at']
\ No newline at end of file
+    readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(MapFileBlob)
+class MapFileBlobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'size', 'ref_count', 'created_at']
+    search_fields = ['name']
+    readonly_fields = ['name', 'size', 'ref_count', 'created_at']
+
+
+@admin.register(ChunkedUpload)
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'owner', 'size', 'status', 'created_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['filename', 'owner__username']
+    readonly_fields = ['sha256', 'created_at', 'updated_at']
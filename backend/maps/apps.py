@@ -3,8 +3,64 @@ App configuration for maps app.
 """
 
 from django.apps import AppConfig
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import pre_migrate
+
+# Postgres extensions the maps indexes rely on
+POSTGRES_EXTENSIONS = ['btree_gist', 'pg_trgm']
+
+
+def create_postgres_extensions(using, **kwargs):
+    """
+    Create required extensions before migrating. Migrations are generated
+    per install, so this cannot live in a migration file.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for extension in POSTGRES_EXTENSIONS:
+            cursor.execute(f'CREATE EXTENSION IF NOT EXISTS {extension}')
+
+
+def convert_decimal_positions(using, **kwargs):
+    """
+    Convert POI positions stored as decimal percentages to integer
+    thousandths before migrating: the generated AlterField would only cast
+    them, dropping the decimals. Does nothing once converted.
+    """
+    from .models import PointOfInterest
+    from .spatial import POSITION_SCALE
+
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    table = PointOfInterest._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() "
+            "AND table_name = %s AND column_name IN ('x_position', 'y_position') AND data_type = 'numeric'",
+            [table]
+        )
+        columns = [row[0] for row in cursor.fetchall()]
+        if columns:
+            changes = ', '.join(
+                f'ALTER COLUMN {column} TYPE integer USING round({column} * {POSITION_SCALE})' for column in columns
+            )
+            cursor.execute(f'ALTER TABLE {table} {changes}')
 
 
 class MapsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'maps'
\ No newline at end of file
+    name = 'maps'
+
+    def ready(self):
+        from PIL import Image
+
+        # Floor plans and site maps are far larger than Pillow's default
+        # decompression-bomb limit.
+        Image.MAX_IMAGE_PIXELS = settings.MAP_IMAGE_MAX_PIXELS
+
+        pre_migrate.connect(create_postgres_extensions, sender=self)
+        pre_migrate.connect(convert_decimal_positions, sender=self)
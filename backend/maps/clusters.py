@@ -0,0 +1,188 @@
+"""
+Server-side POI clustering.
+POIs are counted on a grid per zoom level: zoom 0 splits the map into
+CLUSTER_GRID_SIZE x CLUSTER_GRID_SIZE cells and every zoom level halves
+the cell side. Each cell keeps its count and coordinate sums per
+(layer, own color) group, so centroids are exact, even for a subset of
+layers, and layer colors are looked up when clusters are returned.
+
+Cells and sums are computed on the stored integer positions, so the
+database and Python agree exactly.
+
+Every zoom level is cached per map, stamped with Map.poi_revision. A POI
+change stores only its delta under the revision it produced, after
+commit; a level built before that already counts the change. Reading a
+level applies the deltas it is missing; a level is rebuilt from the
+database only when one of them is unknown or expired. Deltas only reach
+other processes through a shared cache backend (see CACHES).
+"""
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Greatest, Least
+
+from .spatial import POSITION_SCALE
+
+CLUSTER_GRID_SIZE = 16  # Cells per side at zoom 0
+CLUSTER_MAX_ZOOM = 6  # 1024 cells per side, below that clients load POIs by bbox
+CLUSTER_CACHE_TIMEOUT = 24 * 60 * 60
+CLUSTER_MAX_DELTAS = 1000  # Older levels are rebuilt instead of replaying deltas
+CLUSTER_CACHE_VERSION = 2  # Bumped when the cached layout changes
+
+
+def cells_per_side(zoom):
+    return CLUSTER_GRID_SIZE << zoom
+
+
+def cell_of(x, y, zoom):
+    """
+    Grid cell containing a stored position. Derived from the finest level
+    so every level nests exactly.
+    """
+    cells = cells_per_side(CLUSTER_MAX_ZOOM)
+    shift = CLUSTER_MAX_ZOOM - zoom
+    return (
+        min(max(int(x) * cells // (100 * POSITION_SCALE), 0), cells - 1) >> shift,
+        min(max(int(y) * cells // (100 * POSITION_SCALE), 0), cells - 1) >> shift,
+    )
+
+
+def _level_key(map_id, zoom):
+    return f'poi-clusters:v{CLUSTER_CACHE_VERSION}:{map_id}:{zoom}'
+
+
+def _delta_key(map_id, revision):
+    return f'poi-clusters:v{CLUSTER_CACHE_VERSION}:{map_id}:delta:{revision}'
+
+
+def _cell_expression(field, zoom):
+    # Same integer arithmetic as cell_of(), evaluated in the database. Division
+    # truncates instead of flooring below 0, where both are clamped to 0
+    cells = cells_per_side(CLUSTER_MAX_ZOOM)
+    cell = F(field) * cells / (100 * POSITION_SCALE)
+    return Least(Greatest(cell, 0), cells - 1) / (1 << (CLUSTER_MAX_ZOOM - zoom))
+
+
+def _add(cells, cell, group, count, sum_x, sum_y):
+    """Add (or subtract) POIs to one group of a cell, dropping emptied entries."""
+    groups = cells.setdefault(cell, {})
+    entry = groups.get(group)
+    if entry is None:
+        entry = groups[group] = [0, 0, 0]
+    entry[0] += count
+    entry[1] += sum_x
+    entry[2] += sum_y
+    if entry[0] <= 0:
+        del groups[group]
+        if not groups:
+            del cells[cell]
+
+
+def build_level(map_id, zoom):
+    """
+    Aggregate a map's POIs into the cells of one zoom level.
+    The map row is locked meanwhile. Every POI change bumps the revision
+    under that lock in the transaction that writes it, so the lock waits
+    for changes in progress and the counts match the revision read.
+    """
+    from .models import Map, PointOfInterest
+
+    with transaction.atomic():
+        revision = Map.objects.select_for_update().values_list('poi_revision', flat=True).get(pk=map_id)
+        rows = (
+            PointOfInterest.objects.filter(map_id=map_id)
+            .annotate(cell_x=_cell_expression('x_position', zoom), cell_y=_cell_expression('y_position', zoom))
+            .values_list('cell_x', 'cell_y', 'layer_id', 'color')
+            .annotate(count=Count('id'), sum_x=Sum('x_position'), sum_y=Sum('y_position'))
+            .order_by()
+        )
+        cells = {}
+        for cell_x, cell_y, layer_id, color, count, sum_x, sum_y in rows:
+            _add(cells, (cell_x, cell_y), (layer_id, color), count, sum_x, sum_y)
+
+    return {'revision': revision, 'cells': cells}
+
+
+def _apply_delta(level, zoom, delta):
+    for entries, sign in ((delta['removed'], -1), (delta['added'], 1)):
+        for x, y, layer_id, color in entries:
+            _add(level['cells'], cell_of(x, y, zoom), (layer_id, color), sign, sign * x, sign * y)
+
+
+def get_level(map_obj, zoom):
+    """The cells of one zoom level at the map's current POI revision."""
+    key = _level_key(map_obj.pk, zoom)
+    level = cache.get(key)
+    target = map_obj.poi_revision
+
+    if level is not None and level['revision'] != target:
+        missing = range(level['revision'] + 1, target + 1)
+        deltas = cache.get_many([_delta_key(map_obj.pk, revision) for revision in missing]) if missing else {}
+        if not missing or len(missing) > CLUSTER_MAX_DELTAS or len(deltas) != len(missing):
+            level = None  # Newer than this request's map, or a delta is unknown
+        else:
+            for revision in missing:
+                _apply_delta(level, zoom, deltas[_delta_key(map_obj.pk, revision)])
+            level['revision'] = target
+            cache.set(key, level, CLUSTER_CACHE_TIMEOUT)
+
+    if level is None:
+        level = build_level(map_obj.pk, zoom)
+        cache.set(key, level, CLUSTER_CACHE_TIMEOUT)
+    return level
+
+
+def record_delta(map_id, revision, removed=(), added=()):
+    """
+    Store the change that produced revision, as lists of removed and added
+    (x, y, layer_id, color) entries. removed=None means the previous state
+    is unknown, so cached levels are rebuilt instead.
+    """
+    if removed is None:
+        return
+    delta = {'removed': list(removed), 'added': list(added)}
+    cache.set(_delta_key(map_id, revision), delta, CLUSTER_CACHE_TIMEOUT)
+
+
+def forget_levels(map_id):
+    cache.delete_many([_level_key(map_id, zoom) for zoom in range(CLUSTER_MAX_ZOOM + 1)])
+
+
+def clusters_for(level, zoom, layer_colors, default_color, bbox=None, layers=None):
+    """
+    Clusters of one zoom level, optionally limited to centroids inside
+    bbox and to some layers (None in layers selects POIs without one).
+    Each cluster has its count, centroid, cell bounds and dominant color.
+    """
+    side = 100 / cells_per_side(zoom)
+    clusters = []
+    for (cell_x, cell_y), groups in level['cells'].items():
+        count, sum_x, sum_y = 0, 0, 0
+        colors = {}
+        for (layer_id, color), (group_count, group_x, group_y) in groups.items():
+            if layers is not None and layer_id not in layers:
+                continue
+            count += group_count
+            sum_x += group_x
+            sum_y += group_y
+            # Same fallback as PointOfInterest.display_color
+            display_color = color or layer_colors.get(layer_id) or default_color
+            colors[display_color] = colors.get(display_color, 0) + group_count
+        if not count:
+            continue
+
+        x, y = sum_x / count / POSITION_SCALE, sum_y / count / POSITION_SCALE
+        if bbox and not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+            continue
+        clusters.append({
+            'count': count,
+            'x': round(x, 3),
+            'y': round(y, 3),
+            'color': max(sorted(colors), key=colors.get),
+            'bounds': [
+                round(cell_x * side, 3), round(cell_y * side, 3),
+                round((cell_x + 1) * side, 3), round((cell_y + 1) * side, 3),
+            ],
+        })
+    return clusters
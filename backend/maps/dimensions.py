@@ -0,0 +1,32 @@
+"""
+Header-only dimension extraction for map files.
+Only the image header or the PDF page tree is read, never the pixel data,
+so this stays cheap even for very large uploads.
+"""
+
+import pymupdf
+from PIL import Image
+
+
+def read_image_size(path):
+    """Return (width, height) of an image from its header."""
+    # Image.open is lazy: it parses the header and defers decoding to load()
+    with Image.open(path) as image:
+        return image.size
+
+
+def read_pdf_size(path):
+    """Return (width, height) of the first page box of a PDF, in points."""
+    with pymupdf.open(path) as document:
+        rect = document[0].rect
+        return round(rect.width), round(rect.height)
+
+
+def read_map_dimensions(path, file_type):
+    """Return (width, height) of a map file, or None if it cannot be read."""
+    try:
+        if file_type == 'pdf':
+            return read_pdf_size(path)
+        return read_image_size(path)
+    except (OSError, RuntimeError, IndexError, Image.DecompressionBombError):
+        return None
@@ -0,0 +1,68 @@
+"""
+WebP display derivatives of map images.
+PNG and TIFF scans are often many times larger than needed on screen,
+so each image map gets a lossy WebP copy for display while the original
+is kept for download. Like thumbnails, the derivative is stored beside
+the file it was made from and shared by maps using the same file.
+"""
+
+import posixpath
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+DISPLAY_CONTENT_TYPE = 'image/webp'
+WEBP_MAX_SIDE = 16383  # Largest width or height the WebP format allows
+
+
+def display_path(file_name):
+    """Storage path of the display derivative of a map file."""
+    directory, base = posixpath.split(file_name)
+    stem = posixpath.splitext(base)[0]
+    return f'{directory}/display/{stem}.webp'
+
+
+def build_display_image(map_obj):
+    """
+    Encode the WebP display derivative of an image map.
+    Returns whether a derivative exists afterwards. None is kept when the
+    original is already WebP or the encoded copy would not be smaller.
+    """
+    name = display_path(map_obj.file.name)
+    if default_storage.exists(name):
+        return True
+
+    with map_obj.file.open('rb') as source, Image.open(source) as image:
+        if image.format == 'WEBP':
+            return False
+        image.thumbnail((WEBP_MAX_SIDE, WEBP_MAX_SIDE))
+        image = _webp_mode(image)
+
+        buffer = BytesIO()
+        image.save(buffer, format='WEBP', quality=settings.MAP_DISPLAY_WEBP_QUALITY, method=4)
+
+    if buffer.tell() >= map_obj.file.size:
+        return False
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+    return True
+
+
+def _webp_mode(image):
+    """Convert to RGB, or RGBA when the image has transparency."""
+    if image.mode in ('RGB', 'RGBA'):
+        return image
+    if image.mode in ('LA', 'PA') or 'transparency' in image.info:
+        return image.convert('RGBA')
+    if image.mode.startswith('I'):
+        # 16-bit scans are scaled into 8 bits before converting
+        return image.convert('I').point(lambda value: value * (1 / 256)).convert('RGB')
+    return image.convert('RGB')
+
+
+def delete_display_image(file_name):
+    """Remove the display derivative generated from a map file."""
+    if file_name:
+        default_storage.delete(display_path(file_name))
@@ -0,0 +1,54 @@
+"""
+Filter backends for the maps app.
+"""
+
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+from rest_framework.settings import api_settings
+
+from .search import search, vector_fields
+from .spatial import filter_bbox, parse_bbox
+
+
+class BoundingBoxFilter(filters.BaseFilterBackend):
+    """
+    Viewport filter for POIs: ?bbox=x0,y0,x1,y1 in map percentage
+    coordinates. Answered from the spatial index on POI positions.
+    """
+    query_param = 'bbox'
+
+    def filter_queryset(self, request, queryset, view):
+        value = request.query_params.get(self.query_param)
+        if not value:
+            return queryset
+        try:
+            bbox = parse_bbox(value)
+        except ValueError:
+            raise ValidationError({self.query_param: 'Expected four comma-separated numbers: x0,y0,x1,y1.'})
+        return filter_bbox(queryset, bbox)
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    ?search= answered from the model's search_vector column when it covers
+    all of the view's search_fields: every word must match, the best
+    matches come first unless ?ordering= is given, and words match as
+    prefixes. Other search_fields fall back to SearchFilter's lookups.
+    Comes after OrderingFilter, so ranking can take over the default order.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        search_terms = self.get_search_terms(request)
+        if not search_fields or not search_terms:
+            return queryset
+        if not set(search_fields) <= vector_fields(queryset.model):
+            return super().filter_queryset(request, queryset, view)
+
+        matches = search(queryset, search_terms)
+        if matches is None:
+            return super().filter_queryset(request, queryset, view)
+        if request.query_params.get(api_settings.ORDERING_PARAM):
+            return matches
+        ordering = matches.query.order_by or queryset.model._meta.ordering
+        return matches.order_by('-search_rank', *ordering)
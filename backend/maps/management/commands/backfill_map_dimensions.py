@@ -0,0 +1,71 @@
+"""
+Fill Map.width and Map.height for existing maps from their file headers.
+Usage: python manage.py backfill_map_dimensions [--workers N] [--all]
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from maps.dimensions import read_map_dimensions
+from maps.models import Map
+
+BATCH_SIZE = 500
+
+
+def _read_dimensions(args):
+    pk, path, file_type = args
+    return pk, read_map_dimensions(path, file_type)
+
+
+class Command(BaseCommand):
+    help = 'Read width and height of existing maps from their file headers, in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of worker processes (default: CPU count).'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Recompute dimensions for every map, not only maps missing them.'
+        )
+
+    def handle(self, *args, **options):
+        maps = Map.objects.exclude(file='')
+        if not options['all']:
+            maps = maps.filter(Q(width__isnull=True) | Q(height__isnull=True))
+
+        jobs = [
+            (pk, default_storage.path(name), file_type)
+            for pk, name, file_type in maps.values_list('pk', 'file', 'file_type').iterator()
+        ]
+        if not jobs:
+            self.stdout.write('No maps need dimensions.')
+            return
+
+        updated = []
+        failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            for pk, size in executor.map(_read_dimensions, jobs, chunksize=16):
+                if size is None:
+                    failed += 1
+                    self.stderr.write(f'Could not read dimensions for map {pk}.')
+                    continue
+                updated.append(Map(pk=pk, width=size[0], height=size[1]))
+                if len(updated) >= BATCH_SIZE:
+                    Map.objects.bulk_update(updated, ['width', 'height'])
+                    updated = []
+
+        if updated:
+            Map.objects.bulk_update(updated, ['width', 'height'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated dimensions for {len(jobs) - failed} map(s), {failed} failed.'
+        ))
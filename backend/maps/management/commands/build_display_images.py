@@ -0,0 +1,22 @@
+"""
+Queue WebP display images for existing image maps.
+Usage: python manage.py build_display_images
+"""
+
+from django.core.management.base import BaseCommand
+
+from jobs.queue import enqueue
+from maps.models import Map
+
+
+class Command(BaseCommand):
+    help = 'Queue a background job building the WebP display image of every image map missing one.'
+
+    def handle(self, *args, **options):
+        maps = Map.objects.filter(file_type='image', has_display_image=False).exclude(file='')
+        queued = 0
+        for map_obj in maps.only('pk', 'file').iterator():
+            enqueue('maps.build_display_image', target=map_obj, map_id=map_obj.pk, file_name=map_obj.file.name)
+            queued += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Queued display images for {queued} map(s).'))
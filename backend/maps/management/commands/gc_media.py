@@ -0,0 +1,220 @@
+"""
+Delete media files that no Map, UserProfile or upload references, and
+chunked uploads left idle for CHUNKED_UPLOAD_EXPIRY.
+Usage: python manage.py gc_media [--dry-run] [--min-age SECONDS]
+"""
+
+import os
+import re
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts.models import UserProfile
+from maps.models import ChunkedUpload, Map, MapFileBlob
+from maps.uploads import upload_dir
+
+BATCH_SIZE = 500
+
+DERIVED_ROOT_RE = re.compile(r'^maps/user_(\d+)/(?:tiles|pages)$')
+MAP_DIR_RE = re.compile(r'^map_(\d+)$')
+THUMBNAIL_RE = re.compile(r'^(.+)_[a-z]+\.jpg$')
+DISPLAY_IMAGE_RE = re.compile(r'^(.+)\.webp$')
+
+
+def _batches(items):
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start:start + BATCH_SIZE]
+
+
+def _referenced(queryset, field, names):
+    """The subset of names stored in field, queried in batches."""
+    found = set()
+    for batch in _batches(names):
+        found.update(queryset.filter(**{f'{field}__in': batch}).values_list(field, flat=True))
+    return found
+
+
+def _stem(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def _source_stem(name, pattern):
+    """Stem of the map file a thumbnail or display image was made from."""
+    match = pattern.match(os.path.basename(name))
+    return match.group(1) if match else None
+
+
+def _tree_stats(path):
+    """Newest modification time and total size of the files under path."""
+    newest, size = 0, 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                continue
+            newest = max(newest, stat.st_mtime)
+            size += stat.st_size
+    return newest, size
+
+
+def _within(rel, directories):
+    """Whether rel is one of directories or inside one of them."""
+    parts = rel.split('/')
+    return any('/'.join(parts[:depth]) in directories for depth in range(1, len(parts) + 1))
+
+
+class Command(BaseCommand):
+    help = ('Walk MEDIA_ROOT and delete files that no map, profile or chunked upload references, '
+            'and chunked uploads left idle for CHUNKED_UPLOAD_EXPIRY.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report unreferenced files without deleting them.'
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=60 * 60,
+            help='Only delete files older than this many seconds (default: 3600), '
+                 'so uploads still being saved are left alone.'
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.cutoff = time.time() - options['min_age']
+        self.verbosity = options['verbosity']
+        self.counts = {}
+        self.bytes = 0
+
+        self.expire_uploads()
+
+        root = str(settings.MEDIA_ROOT)
+        uploads_root = os.path.relpath(settings.CHUNKED_UPLOAD_ROOT, root).replace(os.sep, '/')
+        orphan_dirs = set()  # Directories of deleted maps and uploads, removed once empty
+        referenced_stems = {}  # Stems of referenced map files, per directory
+
+        # os.walk yields one directory at a time, so the tree is never held in memory
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            rel = '' if rel == '.' else rel
+            names = [f'{rel}/{filename}' if rel else filename for filename in sorted(filenames)]
+
+            if rel and _within(rel, orphan_dirs):
+                self.collect(names, 'tiles, pages and uploads')
+                continue
+
+            if rel == '':
+                dirnames[:] = [name for name in dirnames if name in ('maps', 'profile_pictures', uploads_root)]
+            elif rel == uploads_root:
+                orphan_dirs.update(self.orphan_uploads(rel, dirnames))
+                dirnames[:] = [name for name in dirnames if f'{rel}/{name}' in orphan_dirs]
+            elif DERIVED_ROOT_RE.match(rel):
+                orphan_dirs.update(self.orphan_map_dirs(rel, dirnames))
+                dirnames[:] = [name for name in dirnames if f'{rel}/{name}' in orphan_dirs]
+            elif rel.startswith('profile_pictures'):
+                used = _referenced(UserProfile.objects, 'profile_picture', names)
+                self.collect([name for name in names if name not in used], 'profile pictures')
+            elif rel.startswith('maps') and os.path.basename(rel) in ('thumbnails', 'display'):
+                pattern = THUMBNAIL_RE if rel.endswith('thumbnails') else DISPLAY_IMAGE_RE
+                stems = referenced_stems.get(os.path.dirname(rel), set())
+                self.collect([name for name in names if _source_stem(name, pattern) not in stems], 'map derivatives')
+            elif rel.startswith('maps'):
+                used = _referenced(Map.objects, 'file', names)
+                referenced_stems[rel] = {_stem(name) for name in used}
+                deleted = self.collect([name for name in names if name not in used], 'map files')
+                if deleted and not self.dry_run:
+                    MapFileBlob.objects.filter(name__in=deleted).delete()
+
+        if not self.dry_run:
+            for path in orphan_dirs:
+                self.remove_empty_dirs(os.path.join(root, path))
+
+        total = sum(self.counts.values())
+        summary = ', '.join(f'{count} {category}' for category, count in self.counts.items()) or 'nothing'
+        verb = 'Would delete' if self.dry_run else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {total} file(s), {self.bytes / 1024 / 1024:.1f} MB: {summary}.'
+        ))
+
+    def expire_uploads(self):
+        """
+        Delete (or report) chunked uploads, finished or not, that were neither
+        saved nor sent a chunk for CHUNKED_UPLOAD_EXPIRY. Their directories
+        go with them.
+        """
+        expiry = timezone.now() - timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY)
+        expired = 0
+        for upload in ChunkedUpload.objects.filter(updated_at__lt=expiry).iterator():
+            newest, size = _tree_stats(upload_dir(upload))
+            if newest > expiry.timestamp():
+                continue  # Still receiving chunks
+
+            if self.dry_run or self.verbosity >= 2:
+                self.stdout.write(f'upload {upload.pk}: {upload.filename} ({size} bytes)')
+            if not self.dry_run:
+                upload.delete()
+            expired += 1
+            self.bytes += size
+
+        if expired:
+            self.counts['abandoned uploads'] = expired
+
+    def orphan_uploads(self, rel, dirnames):
+        """Upload directories whose ChunkedUpload no longer exists."""
+        ids = {}
+        for name in dirnames:
+            try:
+                ids[name] = uuid.UUID(name)
+            except ValueError:
+                continue
+        existing = {str(pk) for pk in _referenced(ChunkedUpload.objects, 'pk', list(ids.values()))}
+        return [f'{rel}/{name}' for name, pk in ids.items() if str(pk) not in existing]
+
+    def orphan_map_dirs(self, rel, dirnames):
+        """Tile and page directories of maps that no longer exist."""
+        owner_id = int(DERIVED_ROOT_RE.match(rel).group(1))
+        ids = {name: int(MAP_DIR_RE.match(name).group(1)) for name in dirnames if MAP_DIR_RE.match(name)}
+        existing = _referenced(Map.objects.filter(owner_id=owner_id), 'pk', list(ids.values()))
+        return [f'{rel}/{name}' for name, pk in ids.items() if pk not in existing]
+
+    def collect(self, names, category):
+        """
+        Delete (or report) unreferenced files older than --min-age.
+        Returns the names that were deleted.
+        """
+        deleted = []
+        for name in names:
+            try:
+                stat = os.stat(default_storage.path(name))
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > self.cutoff:
+                continue
+
+            if self.dry_run or self.verbosity >= 2:
+                self.stdout.write(f'{name} ({stat.st_size} bytes)')
+            if not self.dry_run:
+                default_storage.delete(name)
+            deleted.append(name)
+            self.bytes += stat.st_size
+
+        if deleted:
+            self.counts[category] = self.counts.get(category, 0) + len(deleted)
+        return deleted
+
+    def remove_empty_dirs(self, path):
+        """Remove a directory tree left empty by the deletions, bottom up."""
+        for dirpath, _, _ in os.walk(path, topdown=False):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass  # Still holds files younger than --min-age
@@ -0,0 +1,100 @@
+"""
+Import POIs into a map from a CSV or GeoJSON file.
+Usage: python manage.py import_pois MAP_ID FILE [--format csv|geojson] [--user USERNAME]
+                                    [--column FIELD=COLUMN ...] [--rejects FILE]
+"""
+
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from maps.models import Map
+from maps.poi_import import (
+    IMPORT_FIELDS,
+    IMPORT_FORMATS,
+    IMPORT_MAX_REJECTS,
+    PoiImportError,
+    detect_format,
+    import_rows,
+    read_rows
+)
+
+
+class Command(BaseCommand):
+    help = 'Stream POIs from a CSV or GeoJSON file into a map, creating missing layers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('map_id', type=int)
+        parser.add_argument('path')
+        parser.add_argument(
+            '--format',
+            choices=IMPORT_FORMATS,
+            help='File format (default: from the file extension).'
+        )
+        parser.add_argument(
+            '--user',
+            help='Username recorded as creator of the POIs (default: the map owner).'
+        )
+        parser.add_argument(
+            '--column',
+            action='append',
+            default=[],
+            metavar='FIELD=COLUMN',
+            help=f"Read a field from another column, repeatable. Fields: {', '.join(IMPORT_FIELDS)}."
+        )
+        parser.add_argument(
+            '--rejects',
+            help=f'Write the first {IMPORT_MAX_REJECTS} rejected rows to this file, one JSON object per line.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            map_obj = Map.objects.get(pk=options['map_id'])
+        except Map.DoesNotExist:
+            raise CommandError(f"Map {options['map_id']} does not exist.")
+        user = map_obj.owner
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"User {options['user']} does not exist.")
+
+        file_format = options['format'] or detect_format(options['path'])
+        if file_format is None:
+            raise CommandError('Cannot tell the format from the file name, use --format.')
+        columns = {}
+        for mapping in options['column']:
+            field, _, column = mapping.partition('=')
+            if not column:
+                raise CommandError(f'Expected FIELD=COLUMN, got {mapping}.')
+            columns[field] = column
+
+        with open(options['path'], 'rb') as file:
+            try:
+                rows = read_rows(file, file_format, columns)
+            except PoiImportError as exc:
+                raise CommandError(str(exc))
+
+            for event in import_rows(map_obj, user, rows):
+                if 'progress' in event:
+                    progress = event['progress']
+                    self.stdout.write(f"{progress['rows']} rows read, {progress['imported']} imported, "
+                                      f"{progress['rejected']} rejected")
+                    continue
+                result = event['done']
+
+        if options['rejects']:
+            with open(options['rejects'], 'w') as rejects:
+                for reject in result['rejects']:
+                    rejects.write(json.dumps(reject) + '\n')
+        elif result['rejects'] and options['verbosity'] >= 2:
+            for reject in result['rejects']:
+                self.stdout.write(f"Row {reject['row']}: {json.dumps(reject['errors'])}")
+
+        if result['layers_created']:
+            self.stdout.write(f"Created layers: {', '.join(result['layers_created'])}")
+        summary = (f"Imported {result['imported']} of {result['rows']} row(s), "
+                   f"{result['rejected']} rejected.")
+        if 'error' in result:
+            raise CommandError(f"{result['error']} {summary}")
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,44 @@
+"""
+Delete tombstones of deleted POIs and layers older than the retention period.
+Usage: python manage.py prune_tombstones [--days N]
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Max
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from maps.models import Map, Tombstone
+
+
+class Command(BaseCommand):
+    help = 'Delete old tombstones; changes feed cursors from before them get the full state again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.MAP_TOMBSTONE_RETENTION_DAYS,
+            help='Keep tombstones younger than this many days (default: MAP_TOMBSTONE_RETENTION_DAYS).'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        old = Tombstone.objects.filter(deleted_at__lt=cutoff)
+
+        with transaction.atomic():
+            # Cursors from before the last pruned deletion can no longer see every deletion
+            pruned = old.values('map_id').annotate(revision=Max('revision')).order_by()
+            for row in pruned:
+                Map.objects.filter(pk=row['map_id']).update(
+                    pruned_revision=Greatest(F('pruned_revision'), row['revision'])
+                )
+            deleted, _ = old.delete()
+            # Left by layers deleted along with their map, see Tombstone.map
+            orphans, _ = Tombstone.objects.exclude(map_id__in=Map.objects.values('pk')).delete()
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted + orphans} tombstone(s).'))
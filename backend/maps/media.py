@@ -0,0 +1,189 @@
+"""
+Access-controlled media serving.
+Files are handed to the front web server through X-Accel-Redirect or
+X-Sendfile when offload is configured, otherwise streamed with a
+FileResponse that keeps the file descriptor so the WSGI server can
+sendfile it. Range requests, strong ETags and long-lived caching for
+immutable file versions are handled here in both cases, as is picking
+a file variant from the Accept header.
+"""
+
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+QUALITY_RE = re.compile(r'^q=([0-9.]+)$')
+BLOB_DIGEST_RE = re.compile(r'^maps/blobs/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.')
+
+
+class RangeFile:
+    """
+    File-like view of one byte range.
+    Keeps fileno() with the file positioned at the range start, so the
+    WSGI server can still sendfile exactly Content-Length bytes.
+    """
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def file_etag(name, stat):
+    """Strong ETag: the content hash for deduplicated blobs, else mtime and size."""
+    match = BLOB_DIGEST_RE.match(name)
+    if match:
+        return f'"{match.group(1)}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def normalized_name(name):
+    """
+    name when it is already a normalized relative storage path, else None.
+    Access rules match on name prefixes, so a name that '..' or extra
+    slashes would move elsewhere must not reach them.
+    """
+    normalized = posixpath.normpath(name or '.')
+    if normalized != name or normalized.startswith(('/', '../')) or normalized in ('.', '..'):
+        return None
+    return normalized
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header into (start, end), inclusive.
+    Returns None to serve the whole file, or raises ValueError when the
+    range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+def parse_accept(header):
+    """Parse an Accept header into a dict of media range -> quality."""
+    ranges = {}
+    for part in (header or '').split(','):
+        media_range, *params = [item.strip() for item in part.split(';')]
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            match = QUALITY_RE.match(param)
+            if match:
+                try:
+                    quality = float(match.group(1))
+                except ValueError:
+                    quality = 0.0
+        ranges[media_range.lower()] = quality
+    return ranges
+
+
+def accept_quality(ranges, content_type):
+    """Quality given to content_type by the most specific matching media range."""
+    main_type = content_type.split('/')[0]
+    for media_range in (content_type, f'{main_type}/*', '*/*'):
+        if media_range in ranges:
+            return ranges[media_range]
+    return 0.0
+
+
+def serve_file(request, name, content_type=None, cache_control=None):
+    """
+    Serve a file from default storage after access has been checked.
+    Content-addressed map blobs and their derivatives never change, so they
+    are cached for a year; everything else is revalidated by ETag.
+    Negotiated URLs pass cache_control, as their file can change.
+    """
+    try:
+        path = default_storage.path(name)
+        stat = os.stat(path)
+    except (SuspiciousFileOperation, FileNotFoundError, NotADirectoryError):
+        raise Http404("File not found.")
+
+    etag = file_etag(name, stat)
+    if cache_control is None:
+        cache_control = IMMUTABLE_CACHE_CONTROL if name.startswith('maps/blobs/') else REVALIDATE_CACHE_CONTROL
+    content_type = content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = cache_control
+        return response
+
+    if settings.MEDIA_OFFLOAD:
+        # The front web server handles Range and streams the bytes itself
+        response = HttpResponse(content_type=content_type)
+        if settings.MEDIA_OFFLOAD == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(name)
+        else:
+            response['X-Sendfile'] = path
+    else:
+        response = _file_response(request, path, stat.st_size, etag, content_type)
+
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+
+def _file_response(request, path, size, etag, content_type):
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), content_type=content_type, status=206)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -1,24 +1,49 @@
 """
 Models for the maps app.
-Implements Map, MapLayer, PointOfInterest, and SharedMap models.
+Implements Map, MapFileBlob, MapLayer, PointOfInterest, Tombstone, SharedMap, and ChunkedUpload models.
 """
 
-from django.db import models
+import math
+import time
+import uuid
+
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import pre_save, pre_delete
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, NullIf
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete
 from django.dispatch import receiver
 
+from jobs.queue import enqueue, enqueue_on_commit
+
+from .clusters import forget_levels, record_delta
+from .pdf import pages_dir
+from .search import search_document
+from .spatial import poi_point
+from .storage import map_file_storage
+from .tiles import tiles_dir
+from .uploads import delete_upload_files
+
 
 def map_file_path(instance, filename):
-    """Generate upload path for map files."""
-    return f'maps/user_{instance.owner.id}/{filename}'
+    """
+    Generate upload path for map files.
+    map_file_storage replaces it with a content-addressed name and only
+    keeps the extension.
+    """
+    return f'maps/{filename}'
+
+
+DEFAULT_POI_COLOR = '#e74c3c'  # Default red, for POIs with no color of their own or from a layer
 
 
 class Map(models.Model):
     """Map model for storing uploaded map images or PDFs."""
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True)
-    file = models.FileField(upload_to=map_file_path)
+    file = models.FileField(upload_to=map_file_path, storage=map_file_storage)
     file_type = models.CharField(max_length=10)  # 'image' or 'pdf'
     owner = models.ForeignKey(
         User,
@@ -27,12 +52,30 @@ class Map(models.Model):
     )
     width = models.IntegerField(null=True, blank=True)  # For positioning POIs
     height = models.IntegerField(null=True, blank=True)
+    tile_max_zoom = models.PositiveSmallIntegerField(null=True, blank=True)  # Set once tiles are built
+    page_count = models.PositiveIntegerField(null=True, blank=True)  # PDF maps only
+    page_sizes = models.JSONField(default=list, blank=True)  # [width, height] per page, in PDF points
+    has_thumbnails = models.BooleanField(default=False)
+    has_display_image = models.BooleanField(default=False)  # WebP display derivative exists
+    poi_revision = models.PositiveIntegerField(default=0)  # Bumped on every POI or layer change
+    pruned_revision = models.PositiveIntegerField(default=0)  # Tombstones up to this revision were pruned
     is_public = models.BooleanField(default=False)
+    search_vector = models.GeneratedField(  # Full-text search, kept up to date by Postgres
+        expression=search_document('name', 'description'),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Keyset pagination
+            models.Index(fields=['updated_at', 'id']),
+            models.Index(fields=['created_at', 'id']),
+            GinIndex(fields=['search_vector'], name='map_search_vector_gin'),
+        ]
 
     def __str__(self):
         return f"{self.name} - {self.owner.username}"
@@ -41,31 +84,134 @@ class Map(models.Model):
     def poi_count(self):
         return self.points_of_interest.count()
 
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or 'file' in fields:
+            self._stored_file_name = _loaded_file_name(self)
+
+    @staticmethod
+    def bump_poi_revision(map_id):
+        """Increment a map's POI revision and return the new value, in one statement."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {Map._meta.db_table} SET poi_revision = poi_revision + 1 WHERE id = %s RETURNING poi_revision',
+                [map_id]
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+
+def _loaded_file_name(instance):
+    """Name of the file an instance was loaded with, or None if the field was deferred."""
+    if 'file' not in instance.__dict__:
+        return None
+    value = instance.__dict__['file']
+    return getattr(value, 'name', value) or ''
+
+
+# Signal to remember the stored file, so saves can detect a new one without a query
+@receiver(post_init, sender=Map)
+def remember_map_file(sender, instance, **kwargs):
+    instance._stored_file_name = _loaded_file_name(instance)
+
 
-# Signal to delete old map file when a new one is uploaded
+# Signal to release the old map file when a new one is uploaded
 @receiver(pre_save, sender=Map)
-def delete_old_map_file(sender, instance, **kwargs):
+def delete_old_map_file(sender, instance, update_fields=None, **kwargs):
     if not instance.pk:
         return  # New instance, no old file to delete
+    if update_fields is not None and 'file' not in update_fields:
+        return
+
+    old_name = instance._stored_file_name
+    if old_name is None:
+        # Loaded with the file deferred
+        old_name = Map.objects.filter(pk=instance.pk).values_list('file', flat=True).first()
+
+    # If there was an old file and it's different from the new one, release it
+    if old_name and old_name != instance.file.name:
+        MapFileBlob.release(old_name)
+        instance.tile_max_zoom = None
+        instance.page_count = None
+        instance.page_sizes = []
+        instance.has_thumbnails = False
+        instance.has_display_image = False
+        instance._file_changed = True
+
 
-    try:
-        old_instance = Map.objects.get(pk=instance.pk)
-    except Map.DoesNotExist:
+# Signal to queue processing when a map file is uploaded or replaced
+@receiver(post_save, sender=Map)
+def process_map_file(sender, instance, created, **kwargs):
+    instance._stored_file_name = instance.file.name or ''
+    file_changed = getattr(instance, '_file_changed', False)
+    if not (created or file_changed):
         return
+    instance._file_changed = False
 
-    old_file = old_instance.file
-    new_file = instance.file
+    if not instance.file:
+        return
 
-    # If there was an old file and it's different from the new one, delete it
-    if old_file and old_file != new_file:
-        old_file.delete(save=False)
+    MapFileBlob.acquire(instance.file.name)
+    enqueue(
+        'maps.process_map_file',
+        target=instance,
+        map_id=instance.pk,
+        file_name=instance.file.name,
+        # Fill the coordinate space from the file unless the client supplied one
+        keep_dimensions=bool(created and instance.width and instance.height)
+    )
 
 
 # Signal to delete map file when map is deleted
 @receiver(pre_delete, sender=Map)
 def delete_map_file_on_delete(sender, instance, **kwargs):
     if instance.file:
-        instance.file.delete(save=False)
+        MapFileBlob.release(instance.file.name)
+    enqueue_on_commit('maps.delete_storage_trees', paths=[tiles_dir(instance), pages_dir(instance)])
+    map_id = instance.pk
+    transaction.on_commit(lambda: forget_levels(map_id))
+
+
+class MapFileBlob(models.Model):
+    """
+    MapFileBlob model - one stored map file shared by every Map whose file
+    has identical bytes. Deleted with its file when ref_count reaches zero.
+    """
+    name = models.CharField(max_length=255, unique=True)  # Content-addressed storage path
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+    @classmethod
+    def acquire(cls, name):
+        """Add a reference to the blob stored at name."""
+        with transaction.atomic():
+            blob, _ = cls.objects.select_for_update().get_or_create(
+                name=name,
+                defaults={'size': map_file_storage.size(name)}
+            )
+            cls.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+
+    @classmethod
+    def release(cls, name):
+        """
+        Drop a reference to the blob stored at name. With the last reference
+        the file and its derivatives are deleted by a background job queued
+        once the transaction commits. Files stored before deduplication have
+        no blob and are always deleted.
+        """
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(name=name).first()
+            if blob is not None:
+                if blob.ref_count > 1:
+                    cls.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+                    return
+                blob.delete()
+
+        enqueue_on_commit('maps.delete_blobs', released=[[name, time.time()]])
 
 
 class MapLayer(models.Model):
@@ -84,12 +230,16 @@ class MapLayer(models.Model):
     )
     is_visible = models.BooleanField(default=True)
     order = models.IntegerField(default=0)  # For layer ordering
+    revision = models.PositiveIntegerField(default=0)  # Map POI revision of the last change
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['order', 'name']
         unique_together = ['name', 'map']
+        indexes = [
+            models.Index(fields=['map', 'revision']),
+        ]
 
     def __str__(self):
         return f"{self.name} - {self.map.name}"
@@ -98,6 +248,57 @@ class MapLayer(models.Model):
     def poi_count(self):
         return self.points_of_interest.count()
 
+    def save(self, *args, **kwargs):
+        # Stamped in the same transaction, which holds the map row lock
+        # until the layer is written, so the changes feed finds the layer
+        with transaction.atomic():
+            _stamp_revision(self, kwargs)
+            super().save(*args, **kwargs)
+
+
+def _stamp_revision(instance, save_kwargs):
+    """Bump the map's POI revision and store it on a POI or layer about to be saved."""
+    instance.revision = Map.bump_poi_revision(instance.map_id) or 0
+    if save_kwargs.get('update_fields') is not None:
+        save_kwargs['update_fields'] = {*save_kwargs['update_fields'], 'revision'}
+
+
+def _deleted_with_map(origin):
+    """Whether a delete started from a map, which takes its layers and tombstones along."""
+    if isinstance(origin, models.QuerySet):
+        return origin.model is Map
+    return isinstance(origin, Map)
+
+
+# Signal to remember a layer's map, so moving it leaves a tombstone behind
+@receiver(post_init, sender=MapLayer)
+def remember_layer_map(sender, instance, **kwargs):
+    instance._stored_map_id = instance.__dict__.get('map_id')
+
+
+# Signal to record layer changes, and so the color of its POIs, for clusters and the changes feed
+@receiver(post_save, sender=MapLayer)
+def record_layer_save(sender, instance, created, **kwargs):
+    old_map_id, instance._stored_map_id = instance._stored_map_id, instance.map_id
+    if not created and old_map_id not in (None, instance.map_id):
+        revision = record_poi_change(old_map_id, removed=None)
+        Tombstone.objects.create(map_id=old_map_id, kind='layer', object_id=instance.pk, revision=revision or 0)
+    # Clusters look layer colors up when returned, so only the revision moves
+    record_poi_change(instance.map_id, revision=instance.revision)
+
+
+@receiver(pre_delete, sender=MapLayer)
+def record_layer_delete(sender, instance, origin=None, **kwargs):
+    if _deleted_with_map(origin):
+        return
+    # Its POIs are about to lose their layer in a bulk update, so they are
+    # stamped for the changes feed and cached clusters are rebuilt
+    revision = record_poi_change(instance.map_id, removed=None)
+    if revision is None:
+        return
+    PointOfInterest.objects.filter(layer=instance).update(revision=revision)
+    Tombstone.objects.create(map_id=instance.map_id, kind='layer', object_id=instance.pk, revision=revision)
+
 
 class PointOfInterest(models.Model):
     """PointOfInterest model for marking locations on maps."""
@@ -115,9 +316,10 @@ class PointOfInterest(models.Model):
         blank=True,
         related_name='points_of_interest'
     )
-    # Position on the map (percentage-based for responsiveness)
-    x_position = models.DecimalField(max_digits=6, decimal_places=3)  # 0.000 to 100.000
-    y_position = models.DecimalField(max_digits=6, decimal_places=3)
+    # Position on the map (percentage-based for responsiveness), stored in
+    # thousandths of a percent: 0 to 100000 for 0.000% to 100.000%
+    x_position = models.IntegerField()
+    y_position = models.IntegerField()
     # Optional custom styling (overrides layer styling)
     icon = models.CharField(max_length=50, blank=True)
     color = models.CharField(max_length=7, blank=True)
@@ -126,6 +328,12 @@ class PointOfInterest(models.Model):
         on_delete=models.CASCADE,
         related_name='created_pois'
     )
+    revision = models.PositiveIntegerField(default=0)  # Map POI revision of the last change
+    search_vector = models.GeneratedField(  # Full-text search, kept up to date by Postgres
+        expression=search_document('name', 'description'),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -133,6 +341,19 @@ class PointOfInterest(models.Model):
         verbose_name = 'Point of Interest'
         verbose_name_plural = 'Points of Interest'
         ordering = ['-created_at']
+        indexes = [
+            # Viewport (bbox) queries, needs btree_gist for the map column
+            GistIndex(F('map'), poi_point(), name='poi_map_position_gist'),
+            # Nearest POIs of one layer
+            GistIndex(F('layer'), poi_point(), name='poi_layer_position_gist'),
+            models.Index(fields=['map', 'revision']),
+            # Keyset pagination
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['updated_at', 'id']),
+            GinIndex(fields=['search_vector'], name='poi_search_vector_gin'),
+            # Name autocomplete, needs pg_trgm
+            GinIndex(fields=['name'], opclasses=['gin_trgm_ops'], name='poi_name_trgm_gin'),
+        ]
 
     def __str__(self):
         return f"{self.name} on {self.map.name}"
@@ -144,7 +365,152 @@ class PointOfInterest(models.Model):
             return self.color
         if self.layer:
             return self.layer.color
-        return '#e74c3c'  # Default red
+        return DEFAULT_POI_COLOR
+
+    def save(self, *args, **kwargs):
+        # Stamped in the same transaction, which holds the map row lock
+        # until the POI is written, so the changes feed finds the POI
+        with transaction.atomic():
+            _stamp_revision(self, kwargs)
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # Done here rather than in a delete signal, which would stop Django
+        # from deleting a map's POIs in one query when the map is deleted
+        pk, map_id, entry = self.pk, self.map_id, self._stored_cluster_entry
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            revision = record_poi_change(map_id, removed=[entry] if entry else None)
+            if revision is not None:
+                Tombstone.objects.create(map_id=map_id, kind='poi', object_id=pk, revision=revision)
+        return result
+
+
+def with_layer_fields(queryset):
+    """
+    POIs annotated with layer_name, layer_color and list_display_color,
+    joined in the same query, as read by PointOfInterestListSerializer.
+    """
+    return queryset.annotate(
+        layer_name=F('layer__name'),
+        layer_color=F('layer__color'),
+        # Same fallback as PointOfInterest.display_color
+        list_display_color=Coalesce(NullIf('color', Value('')), 'layer__color', Value(DEFAULT_POI_COLOR)),
+    )
+
+
+def _cluster_entry(instance):
+    """(x, y, layer_id, color) of a POI as loaded, or None if a field was deferred."""
+    fields = ('x_position', 'y_position', 'layer_id', 'color')
+    if not all(field in instance.__dict__ for field in fields):
+        return None
+    return tuple(instance.__dict__[field] for field in fields)
+
+
+def record_poi_change(map_id, removed=(), added=(), revision=None):
+    """
+    Record a change for cached clusters after commit, under the given
+    revision or a newly bumped one. Returns the revision, or None if the
+    map no longer exists.
+    """
+    if revision is None:
+        revision = Map.bump_poi_revision(map_id)
+    if revision is not None:
+        transaction.on_commit(lambda: record_delta(map_id, revision, removed, added))
+    return revision
+
+
+def record_poi_deletes(queryset):
+    """
+    Record POIs about to be deleted without PointOfInterest.delete(), as
+    it would: a new revision per map, a tombstone per POI and the removed
+    cluster entries. Must run in the transaction that deletes them.
+    """
+    by_map = {}
+    rows = queryset.select_for_update(of=('self',)).values_list('id', 'map_id', 'x_position', 'y_position', 'layer_id', 'color')
+    for pk, map_id, *entry in rows.order_by():
+        by_map.setdefault(map_id, []).append((pk, tuple(entry)))
+    # In map order, so concurrent calls lock map rows in the same order
+    for map_id in sorted(by_map):
+        revision = record_poi_change(map_id, removed=[entry for _, entry in by_map[map_id]])
+        if revision is not None:
+            Tombstone.objects.bulk_create([
+                Tombstone(map_id=map_id, kind='poi', object_id=pk, revision=revision) for pk, _ in by_map[map_id]
+            ])
+
+
+def delete_pois(queryset):
+    """Delete POIs in bulk, recorded for the changes feed and caches."""
+    with transaction.atomic():
+        record_poi_deletes(queryset)
+        return queryset.delete()
+
+
+# Signal to record the POIs a deleted user added to other people's maps,
+# which the database removes by cascade. Their own maps go as a whole
+@receiver(pre_delete, sender=User)
+def record_user_poi_deletes(sender, instance, **kwargs):
+    record_poi_deletes(PointOfInterest.objects.filter(created_by=instance).exclude(map__owner=instance))
+
+# Signal to remember the clustered state of a POI, so saves can update clusters incrementally
+@receiver(post_init, sender=PointOfInterest)
+def remember_poi_cluster_entry(sender, instance, **kwargs):
+    instance._stored_map_id = instance.__dict__.get('map_id')
+    instance._stored_cluster_entry = _cluster_entry(instance) if instance.pk else None
+
+
+# Signal to record POI changes for clusters and caches
+@receiver(post_save, sender=PointOfInterest)
+def record_poi_save(sender, instance, created, **kwargs):
+    old_map_id, old_entry = instance._stored_map_id, instance._stored_cluster_entry
+    instance._stored_map_id = instance.map_id
+    instance._stored_cluster_entry = entry = _cluster_entry(instance)
+
+    revision = instance.revision
+    if entry is None:
+        record_poi_change(instance.map_id, removed=None, revision=revision)
+    elif created:
+        record_poi_change(instance.map_id, added=[entry], revision=revision)
+    elif old_map_id not in (None, instance.map_id):
+        # Moved to another map, where it shows up as a deletion
+        old_revision = record_poi_change(old_map_id, removed=[old_entry] if old_entry else None)
+        if old_revision is not None:
+            Tombstone.objects.create(map_id=old_map_id, kind='poi', object_id=instance.pk, revision=old_revision)
+        record_poi_change(instance.map_id, added=[entry], revision=revision)
+    else:
+        record_poi_change(instance.map_id, removed=[old_entry] if old_entry else None, added=[entry], revision=revision)
+
+
+class Tombstone(models.Model):
+    """
+    Tombstone model - a deleted POI or layer, kept so the changes feed
+    can report deletions. Pruned after MAP_TOMBSTONE_RETENTION_DAYS.
+    """
+    KIND_CHOICES = [
+        ('poi', 'Point of Interest'),
+        ('layer', 'Layer'),
+    ]
+
+    # No database constraint: a layer deleted along with its map by a
+    # cascade from elsewhere can still record one after the map is gone
+    map = models.ForeignKey(
+        Map,
+        on_delete=models.CASCADE,
+        related_name='tombstones',
+        db_constraint=False
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    revision = models.PositiveIntegerField()  # Map POI revision of the deletion
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['map', 'revision']),
+        ]
+
+    def __str__(self):
+        return f"Deleted {self.kind} {self.object_id} on map {self.map_id}"
 
 
 class SharedMap(models.Model):
@@ -183,4 +549,54 @@ class SharedMap(models.Model):
         ordering = ['-created_at']
 
     def __str__(self):
-        return f"{self.map.name} shared with {self.shared_with.username}"
\ No newline at end of file
+        return f"{self.map.name} shared with {self.shared_with.username}"
+
+
+class ChunkedUpload(models.Model):
+    """
+    ChunkedUpload model for resumable uploads of large map files.
+    Chunks live on disk until the upload is assembled and attached to a Map.
+    """
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        ('complete', 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='chunked_uploads'
+    )
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    size = models.BigIntegerField()  # Total size in bytes
+    chunk_size = models.PositiveIntegerField()  # Every chunk but the last has this size
+    sha256 = models.CharField(max_length=64, blank=True)  # Set once assembled
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default='uploading'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.filename} ({self.status}) - {self.owner.username}"
+
+    @property
+    def total_chunks(self):
+        return max(1, math.ceil(self.size / self.chunk_size))
+
+    def chunk_length(self, index):
+        """Expected size in bytes of the chunk at index."""
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+
+# Signal to delete chunk files when an upload is removed or attached
+@receiver(pre_delete, sender=ChunkedUpload)
+def delete_chunked_upload_files(sender, instance, **kwargs):
+    delete_upload_files(instance)
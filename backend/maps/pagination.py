@@ -0,0 +1,126 @@
+"""
+Pagination for map and POI lists.
+Page numbers stay the default. Passing ?cursor= (empty for the first
+page) switches to keyset pagination: pages continue after the last row
+seen, on an indexed (timestamp, id) key, so deep pages cost the same as
+the first one and no total is counted.
+"""
+
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+KEYSET_FIELDS = ['created_at', 'updated_at']  # Indexed together with id
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    Page numbers, or keyset pages with opaque next and previous cursors
+    when ?cursor= is given. Keyset pages follow the list's ordering, which
+    must start with created_at or updated_at, either way; ties are broken
+    by id in the same direction.
+    """
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        self.key = self._key(queryset)
+        field = self.key.lstrip('-')
+        descending = self.key.startswith('-')
+        cursor = self._decode(request.query_params[self.cursor_query_param])
+        reverse = bool(cursor and cursor['reverse'])
+
+        # Walking backwards for a previous page flips the order
+        ordering = [self.key, '-pk' if descending else 'pk']
+        if reverse:
+            ordering = [value[1:] if value.startswith('-') else f'-{value}' for value in ordering]
+        if cursor:
+            before = descending != reverse
+            lookup = 'lt' if before else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{field}__{lookup}e': cursor['value']}),
+                Q(**{f'{field}__{lookup}': cursor['value']}) | Q(**{f'pk__{lookup}': cursor['pk']}),
+            )
+
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+
+        self.rows = rows
+        self.has_next = bool(rows) and (cursor is not None if reverse else has_more)
+        self.has_previous = bool(rows) and (has_more if reverse else cursor is not None)
+        return rows
+
+    def _key(self, queryset):
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        first = ordering[0] if ordering else None
+        if not isinstance(first, str) or first.lstrip('-') not in KEYSET_FIELDS:
+            raise ValidationError({
+                self.cursor_query_param: 'Cursor pagination needs the list ordered by created_at or updated_at.'
+            })
+        return first
+
+    def _encode(self, row, reverse):
+        position = {
+            'key': self.key,
+            'value': getattr(row, self.key.lstrip('-')).isoformat(),
+            'pk': row.pk,
+            'reverse': reverse,
+        }
+        return base64.urlsafe_b64encode(json.dumps(position, separators=(',', ':')).encode()).decode()
+
+    def _decode(self, encoded):
+        """Position of a cursor, or None for the first page."""
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            value = parse_datetime(position['value'])
+            valid = position['key'] == self.key and value is not None and isinstance(position['pk'], int)
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            valid = False
+        if not valid:
+            # Also when the ordering changed since the cursor was made
+            raise NotFound(self.invalid_cursor_message)
+        return {'value': value, 'pk': position['pk'], 'reverse': bool(position.get('reverse'))}
+
+    def _link(self, row, reverse):
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self._encode(row, reverse))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        return self._link(self.rows[-1], False) if self.has_next else None
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        return self._link(self.rows[0], True) if self.has_previous else None
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
@@ -0,0 +1,118 @@
+"""
+Server-side rasterization for PDF maps.
+Pages are rendered lazily on first access, in a process pool so large
+PDFs never tie up a web worker, and cached at a few fixed resolutions.
+"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pymupdf
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .utils import delete_storage_tree
+
+# Longest side, in pixels, of each cached page raster
+PAGE_RESOLUTIONS = {
+    'small': 512,
+    'medium': 2048,
+    'large': 4096,
+}
+DEFAULT_PAGE_RESOLUTION = 'medium'
+PAGE_CONTENT_TYPE = 'image/png'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class PdfRenderError(Exception):
+    """Raised when a PDF cannot be read or a page cannot be rendered."""
+
+
+def get_executor():
+    """Return the process pool shared by this web worker."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.PDF_RENDER_WORKERS)
+    return _executor
+
+
+def _discard_executor(executor):
+    """Drop a broken pool, so the next render starts a new one."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_in_pool(func, *args):
+    executor = get_executor()
+    try:
+        return executor.submit(func, *args).result(timeout=settings.PDF_RENDER_TIMEOUT)
+    except BrokenProcessPool as exc:
+        # A worker died, e.g. killed for running out of memory, and the pool
+        # refuses all further work
+        _discard_executor(executor)
+        raise PdfRenderError(str(exc) or 'PDF rendering failed.') from exc
+    except (RuntimeError, ValueError, TimeoutError) as exc:
+        raise PdfRenderError(str(exc) or 'PDF rendering timed out.') from exc
+
+
+# Worker functions run in the process pool, so they only take plain paths.
+
+def _read_page_sizes(path):
+    with pymupdf.open(path) as document:
+        return [[round(page.rect.width, 2), round(page.rect.height, 2)] for page in document]
+
+
+def _render_page(path, page_index, longest_side):
+    with pymupdf.open(path) as document:
+        page = document[page_index]
+        zoom = longest_side / max(page.rect.width, page.rect.height)
+        pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+        return pixmap.tobytes('png')
+
+
+def pages_dir(map_obj):
+    """Storage directory holding the cached page rasters of a map."""
+    return f'maps/user_{map_obj.owner_id}/pages/map_{map_obj.pk}'
+
+
+def page_path(map_obj, page_number, resolution):
+    """Storage path of a single cached page raster."""
+    return f'{pages_dir(map_obj)}/{resolution}/{page_number}.png'
+
+
+def read_page_sizes(map_obj):
+    """Return [width, height] of every page, in PDF points."""
+    return _run_in_pool(_read_page_sizes, map_obj.file.path)
+
+
+def get_page_raster(map_obj, page_number, resolution=DEFAULT_PAGE_RESOLUTION):
+    """
+    Return the storage path of a page raster, rendering it on first access.
+    Page numbers are 1-based.
+    """
+    name = page_path(map_obj, page_number, resolution)
+    if default_storage.exists(name):
+        return name
+
+    content = _run_in_pool(
+        _render_page, map_obj.file.path, page_number - 1, PAGE_RESOLUTIONS[resolution]
+    )
+
+    # Another request may have rendered the same page in the meantime
+    saved_name = default_storage.save(name, ContentFile(content))
+    if saved_name != name:
+        default_storage.delete(saved_name)
+    return name
+
+
+def delete_page_rasters(map_obj):
+    """Remove every cached page raster of a map."""
+    delete_storage_tree(pages_dir(map_obj))
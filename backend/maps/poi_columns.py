@@ -0,0 +1,74 @@
+"""
+Columnar POI payloads.
+Instead of one JSON object per POI, a map's POIs are sent as parallel
+columns plus one table of its layers, read straight from values_list()
+rows. Positions are sent as stored, integers in thousandths of a percent.
+Two encodings:
+
+JSON (?format=columnar)
+    {"count", "scale", "default_color", "layers": [{"id", "name", "color"}],
+     "ids", "names", "x", "y", "layer", "colors"}
+    layer holds indexes into layers, or null; colors the POI's own color.
+
+Binary (?format=columnar-binary), little-endian typed arrays:
+    header   magic 'POIC', version (uint16), 2 zero bytes, count (uint32),
+             4 zero bytes
+    ids      uint64[count]
+    xs, ys   uint32[count], position * scale
+    layer    uint16[count], index into layers, 65535 for none
+    padding  to a multiple of 4 bytes
+    tail     UTF-8 JSON of the other JSON fields: scale, default_color,
+             layers, names and colors, to the end
+"""
+
+import json
+import struct
+
+from .models import DEFAULT_POI_COLOR
+from .poi_tiles import typed_array
+from .spatial import POSITION_SCALE
+
+POI_COLUMNS_FORMAT_VERSION = 2
+POI_COLUMNS_CONTENT_TYPE = 'application/vnd.interactivemap.poi-columns'
+NO_LAYER = 0xFFFF
+
+HEADER = struct.Struct('<4sHxxIxxxx')  # 16 bytes, so every array starts aligned to its type
+
+
+def poi_columns(map_obj, pois):
+    """Columns of a POI queryset of map_obj, in its order."""
+    layers = list(map_obj.layers.values_list('id', 'name', 'color'))
+    layer_index = {layer_id: index for index, (layer_id, _, _) in enumerate(layers)}
+    columns = {
+        'count': 0,
+        'scale': POSITION_SCALE,
+        'default_color': DEFAULT_POI_COLOR,
+        'layers': [{'id': layer_id, 'name': name, 'color': color} for layer_id, name, color in layers],
+        'ids': [], 'names': [], 'x': [], 'y': [], 'layer': [], 'colors': [],
+    }
+    rows = pois.values_list('id', 'name', 'x_position', 'y_position', 'layer_id', 'color')
+    for poi_id, name, x, y, layer_id, color in rows:
+        columns['ids'].append(poi_id)
+        columns['names'].append(name)
+        columns['x'].append(x)
+        columns['y'].append(y)
+        columns['layer'].append(layer_index.get(layer_id))
+        columns['colors'].append(color)
+    columns['count'] = len(columns['ids'])
+    return columns
+
+
+def encode_columns(columns):
+    """Binary encoding of poi_columns() output."""
+    count = columns['count']
+    tail = {key: columns[key] for key in ('scale', 'default_color', 'layers', 'names', 'colors')}
+    body = [
+        HEADER.pack(b'POIC', POI_COLUMNS_FORMAT_VERSION, count),
+        typed_array('Q', columns['ids']),  # POI ids are 64-bit
+        typed_array('I', columns['x']),
+        typed_array('I', columns['y']),
+        typed_array('H', [NO_LAYER if index is None else index for index in columns['layer']]),
+        b'\0' * (2 * count % 4),
+        json.dumps(tail, separators=(',', ':')).encode(),
+    ]
+    return b''.join(body)
@@ -0,0 +1,115 @@
+"""
+Streaming POI export to CSV, GeoJSON and NDJSON.
+POIs are read through a server-side cursor and written out in chunks,
+so memory stays flat whatever the size of the map. Columns match the
+POI list API and are read back by the importer.
+"""
+
+import csv
+import json
+
+from .models import DEFAULT_POI_COLOR
+from .spatial import POSITION_SCALE
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'geojson': 'application/geo+json',
+    'ndjson': 'application/x-ndjson',
+}
+EXPORT_CHUNK_SIZE = 2000  # Rows fetched per cursor round trip and written per response chunk
+EXPORT_FIELDS = [
+    'id', 'name', 'description', 'x_position', 'y_position',
+    'layer_id', 'layer_name', 'layer_color', 'color', 'display_color',
+    'icon', 'created_at', 'updated_at',
+]
+
+
+def _records(map_obj):
+    rows = map_obj.points_of_interest.values_list(
+        'id', 'name', 'description', 'x_position', 'y_position',
+        'layer_id', 'layer__name', 'layer__color', 'color',
+        'icon', 'created_at', 'updated_at',
+    ).order_by('id')
+    for (poi_id, name, description, x, y, layer_id, layer_name, layer_color, color,
+         icon, created_at, updated_at) in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield {
+            'id': poi_id,
+            'name': name,
+            'description': description,
+            'x_position': x / POSITION_SCALE,
+            'y_position': y / POSITION_SCALE,
+            'layer_id': layer_id,
+            'layer_name': layer_name,
+            'layer_color': layer_color,
+            'color': color,
+            # Same fallback as PointOfInterest.display_color
+            'display_color': color or layer_color or DEFAULT_POI_COLOR,
+            'icon': icon,
+            'created_at': created_at.isoformat(),
+            'updated_at': updated_at.isoformat(),
+        }
+
+
+class _Lines:
+    """Write target collecting what csv.writer produces."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, value):
+        self.parts.append(value)
+
+    def take(self):
+        data, self.parts = ''.join(self.parts), []
+        return data
+
+
+def _chunked(lines):
+    """Join lines into chunks of EXPORT_CHUNK_SIZE, as many tiny writes are slow to send."""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _csv_lines(records):
+    buffer = _Lines()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield buffer.take()
+    for record in records:
+        writer.writerow(['' if record[field] is None else record[field] for field in EXPORT_FIELDS])
+        yield buffer.take()
+
+
+def _geojson_lines(records):
+    yield '{"type":"FeatureCollection","features":[\n'
+    separator = ''
+    for record in records:
+        feature = {
+            'type': 'Feature',
+            'id': record['id'],
+            'geometry': {'type': 'Point', 'coordinates': [record['x_position'], record['y_position']]},
+            'properties': {
+                field: record[field] for field in EXPORT_FIELDS
+                if field not in ('id', 'x_position', 'y_position')
+            },
+        }
+        yield separator + json.dumps(feature, separators=(',', ':'))
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+def _ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def export_pois(map_obj, export_format):
+    """Iterator over the encoded chunks of a map's POIs in export_format."""
+    lines = {'csv': _csv_lines, 'geojson': _geojson_lines, 'ndjson': _ndjson_lines}[export_format]
+    return (chunk.encode() for chunk in _chunked(lines(_records(map_obj))))
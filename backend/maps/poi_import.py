@@ -0,0 +1,299 @@
+"""
+Streaming POI import from CSV and GeoJSON files.
+Files are parsed one row or feature at a time, so imports of any size
+run in constant memory. Rows are validated like bulk API writes, layers
+named in the file are created on first use, and valid rows are inserted
+in batches, each committed on its own so progress can be reported.
+"""
+
+import csv
+import io
+import itertools
+import json
+import os
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .models import Map, MapLayer, PointOfInterest, record_poi_change
+from .serializers import PointOfInterestBulkSerializer
+
+IMPORT_FORMATS = ['csv', 'geojson']
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_REJECTS = 1000  # Rejected rows kept for the report, the rest are only counted
+IMPORT_FIELDS = ['name', 'description', 'x_position', 'y_position', 'layer', 'color', 'icon']
+# Columns tried for each field when no mapping is given
+DEFAULT_COLUMNS = {
+    'name': ['name', 'title'],
+    'description': ['description'],
+    'x_position': ['x_position', 'x'],
+    'y_position': ['y_position', 'y'],
+    'layer': ['layer', 'layer_name', 'category'],
+    'color': ['color'],
+    'icon': ['icon'],
+}
+
+JSON_CHUNK_SIZE = 64 * 1024
+JSON_MAX_VALUE_SIZE = 16 * 1024 * 1024  # Largest single feature read into memory
+POSITION = Decimal('0.001')
+
+
+class PoiImportError(Exception):
+    """The file cannot be imported at all, as opposed to a rejected row."""
+
+
+def detect_format(filename):
+    """Import format from a file name, or None."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    return {'.csv': 'csv', '.geojson': 'geojson', '.json': 'geojson'}.get(extension)
+
+
+def read_rows(file, file_format, columns=None):
+    """
+    Iterate over the rows of a binary file as dicts of POI field values,
+    using the optional {field: column} mapping. GeoJSON positions come
+    from Point geometries, other fields from feature properties.
+    Raises PoiImportError when the file does not start as expected.
+    """
+    columns = columns or {}
+    unknown = set(columns) - set(IMPORT_FIELDS)
+    if unknown:
+        raise PoiImportError(f"Unknown fields in column mapping: {', '.join(sorted(unknown))}.")
+
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        return _csv_rows(text, columns)
+    if file_format == 'geojson':
+        return _geojson_rows(text, columns)
+    raise PoiImportError(f"Format must be one of: {', '.join(IMPORT_FORMATS)}.")
+
+
+def _resolve_columns(available, columns):
+    """{field: column} for the fields found among the available columns."""
+    resolved = {}
+    for field in IMPORT_FIELDS:
+        if field in columns:
+            if columns[field] not in available:
+                raise PoiImportError(f"Column '{columns[field]}' mapped to {field} is missing.")
+            resolved[field] = columns[field]
+            continue
+        found = next((column for column in DEFAULT_COLUMNS[field] if column in available), None)
+        if found:
+            resolved[field] = found
+    return resolved
+
+
+def _csv_rows(text, columns):
+    reader = csv.DictReader(text)
+    try:
+        header = reader.fieldnames or []
+    except (csv.Error, UnicodeDecodeError) as exc:
+        raise PoiImportError(f"Unreadable CSV header: {exc}")
+    resolved = _resolve_columns(set(header), columns)
+    missing = [field for field in ('name', 'x_position', 'y_position') if field not in resolved]
+    if missing:
+        raise PoiImportError(f"No column found for: {', '.join(missing)}.")
+
+    def rows():
+        try:
+            for row in reader:
+                yield row, {field: row.get(column) for field, column in resolved.items()}
+        except (csv.Error, UnicodeDecodeError) as exc:
+            raise PoiImportError(f"Unreadable CSV at line {reader.line_num}: {exc}")
+    return rows()
+
+
+def _geojson_rows(text, columns):
+    features = _JsonFeatureReader(text).features()
+    # Reading the first feature fails early on files that are not a FeatureCollection
+    first = list(itertools.islice(features, 1))
+    return (_feature_row(feature, columns) for feature in itertools.chain(first, features))
+
+
+def _feature_row(feature, columns):
+    properties = (feature.get('properties') if isinstance(feature, dict) else None) or {}
+    values = {}
+    for field in IMPORT_FIELDS:
+        column = columns.get(field) or next((name for name in DEFAULT_COLUMNS[field] if name in properties), None)
+        if column in properties:
+            values[field] = properties[column]
+
+    geometry = feature.get('geometry') if isinstance(feature, dict) else None
+    if isinstance(geometry, dict) and geometry.get('type') == 'Point':
+        coordinates = geometry.get('coordinates') or []
+        if len(coordinates) >= 2:
+            values['x_position'], values['y_position'] = coordinates[0], coordinates[1]
+    elif 'x_position' not in values or 'y_position' not in values:
+        values['geometry'] = None  # Reported as a missing Point below
+    return properties, values
+
+
+class _JsonFeatureReader:
+    """
+    Incremental reader for the features of a GeoJSON FeatureCollection.
+    Top-level members are decoded one value at a time from a sliding
+    buffer, and the features array one feature at a time.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.text.read(JSON_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if len(self.buffer) > JSON_MAX_VALUE_SIZE:
+            raise PoiImportError("A GeoJSON value is too large.")
+        return True
+
+    def _peek(self):
+        """Next non-whitespace character, or '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise PoiImportError(f"Invalid GeoJSON: expected '{char}'.")
+        self.pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise PoiImportError("Invalid GeoJSON.")
+            # A number ending the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def features(self):
+        try:
+            self._expect('{')
+            while self._peek() != '}':
+                key = self._value()
+                self._expect(':')
+                if key != 'features':
+                    self._value()
+                elif self._peek() == '[':
+                    self.pos += 1
+                    while self._peek() != ']':
+                        yield self._value()
+                        if self._peek() == ',':
+                            self.pos += 1
+                    self.pos += 1
+                else:
+                    raise PoiImportError("Invalid GeoJSON: features must be a list.")
+                if self._peek() == ',':
+                    self.pos += 1
+                elif self._peek() != '}':
+                    raise PoiImportError("Invalid GeoJSON: expected ',' or '}'.")
+        except UnicodeDecodeError as exc:
+            raise PoiImportError(f"GeoJSON is not valid UTF-8: {exc}")
+
+
+def _position(value):
+    # Positions are stored to 0.001, so finer input is rounded rather than rejected
+    try:
+        return Decimal(str(value).strip()).quantize(POSITION)
+    except (InvalidOperation, ValueError):
+        return value
+
+
+def import_rows(map_obj, user, rows):
+    """
+    Import (raw row, values) pairs from read_rows() into a map.
+    Yields a progress dict after each committed batch, then a summary
+    with the created layers and the first IMPORT_MAX_REJECTS rejects.
+    A file that turns unreadable midway stops the import, keeping the
+    batches already committed, and the summary carries the error.
+    """
+    serializer = PointOfInterestBulkSerializer(context={'layer_ids': set()})
+    layer_name_length = MapLayer._meta.get_field('name').max_length
+    layers = dict(map_obj.layers.values_list('name', 'id'))
+    created_layers = []
+    summary = {'rows': 0, 'imported': 0, 'rejected': 0}
+    rejects = []
+    batch = []
+
+    def reject(number, raw, errors):
+        summary['rejected'] += 1
+        if len(rejects) < IMPORT_MAX_REJECTS:
+            rejects.append({'row': number, 'errors': errors, 'values': raw})
+
+    def flush():
+        with transaction.atomic():
+            revision = Map.bump_poi_revision(map_obj.id)
+            for poi in batch:
+                poi.revision = revision
+            PointOfInterest.objects.bulk_create(batch)
+            record_poi_change(
+                map_obj.id,
+                added=[(poi.x_position, poi.y_position, poi.layer_id, poi.color) for poi in batch],
+                revision=revision
+            )
+        summary['imported'] += len(batch)
+        batch.clear()
+
+    error = None
+    try:
+        for raw, values in rows:
+            summary['rows'] += 1
+            number = summary['rows']
+            if 'geometry' in values:
+                reject(number, raw, {'geometry': ['Expected a Point geometry.']})
+                continue
+
+            layer_name = values.pop('layer', None)
+            layer_name = str(layer_name).strip() if layer_name is not None else ''
+            data = {
+                field: value.strip() if isinstance(value, str) else value
+                for field, value in values.items() if value not in (None, '')
+            }
+            for field in ('x_position', 'y_position'):
+                if field in data:
+                    data[field] = _position(data[field])
+            try:
+                validated = serializer.run_validation(data)
+            except ValidationError as exc:
+                reject(number, raw, exc.detail)
+                continue
+            if len(layer_name) > layer_name_length:
+                reject(number, raw, {'layer': [f'Ensure this field has no more than {layer_name_length} characters.']})
+                continue
+
+            if layer_name and layer_name not in layers:
+                layers[layer_name] = MapLayer.objects.create(map=map_obj, name=layer_name).id
+                created_layers.append(layer_name)
+            validated['layer_id'] = layers.get(layer_name)
+            batch.append(PointOfInterest(map=map_obj, created_by=user, **validated))
+
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+                yield {'progress': dict(summary)}
+    except PoiImportError as exc:
+        error = str(exc)
+
+    if batch:
+        flush()
+    result = {**summary, 'layers_created': created_layers, 'rejects': rejects}
+    if error:
+        result['error'] = error
+    yield {'done': result}
@@ -0,0 +1,129 @@
+"""
+Binary POI tiles.
+The map is split into 2^z x 2^z tiles per zoom level, like the image tile
+pyramid but over POI percentage coordinates. A tile packs its POIs into
+little-endian typed arrays, so clients load them without JSON parsing:
+
+    header   magic 'POIT', version, z (uint16), x, y, count (uint32),
+             4 zero bytes
+    ids      uint64[count], ascending
+    xs, ys   uint16[count], position inside the tile, 0 to 65535
+    style    uint16[count], index into the style dictionary
+    padding  to a multiple of 4 bytes
+    dict     UTF-8 JSON list of {"layer", "name", "color"}, to the end
+
+A position is tile origin + value / 65535 * tile side, which rounds back
+to the stored 0.001% from zoom 1. A style is one (layer, display color)
+pair, so POIs with a color of their own need no extra per-POI field.
+
+Tiles are cached gzipped per map POI revision, which is also their ETag.
+"""
+
+import gzip
+import json
+import math
+import struct
+import sys
+from array import array
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import F, IntegerField
+from django.db.models.functions import Cast, Round
+
+from .spatial import POSITION_SCALE, filter_bbox
+
+POI_TILE_FORMAT_VERSION = 2
+POI_TILE_MAX_ZOOM = 10
+POI_TILE_CONTENT_TYPE = 'application/vnd.interactivemap.poi-tile'
+POI_TILE_CACHE_TIMEOUT = 24 * 60 * 60
+POI_TILE_SCALE = 65535
+
+HEADER = struct.Struct('<4sHHIIIxxxx')  # 24 bytes, so the ids start 8-byte aligned
+
+
+def tile_bounds(z, x, y):
+    """(min_x, min_y, max_x, max_y) of a tile, exact, in percentages."""
+    side = Decimal(100) / (1 << z)
+    return x * side, y * side, (x + 1) * side, (y + 1) * side
+
+
+def poi_tile_etag(map_obj):
+    return f'"poi-{map_obj.pk}-{map_obj.poi_revision}-v{POI_TILE_FORMAT_VERSION}"'
+
+
+def _quantized(field, origin, side):
+    # Offset inside the tile scaled to 0..POI_TILE_SCALE, computed exactly in the database
+    origin, side = origin * POSITION_SCALE, side * POSITION_SCALE
+    return Cast(Round((F(field) - origin) * (POI_TILE_SCALE / side)), IntegerField())
+
+
+def typed_array(typecode, values):
+    """Little-endian bytes of a typed array."""
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def build_poi_tile(map_obj, z, x, y, default_color):
+    """Encode the POIs of one tile."""
+    min_x, min_y, max_x, max_y = bounds = tile_bounds(z, x, y)
+    side = max_x - min_x
+
+    # Tiles own their lower edges; the last row and column also own 100.
+    # Positions are integers, so below an edge is below its ceiling
+    pois = filter_bbox(map_obj.points_of_interest.all(), [float(value) for value in bounds])
+    if max_x < 100:
+        pois = pois.filter(x_position__lt=math.ceil(max_x * POSITION_SCALE))
+    if max_y < 100:
+        pois = pois.filter(y_position__lt=math.ceil(max_y * POSITION_SCALE))
+    rows = pois.values_list(
+        'id',
+        _quantized('x_position', min_x, side),
+        _quantized('y_position', min_y, side),
+        'layer_id',
+        'color',
+    ).order_by('id')
+
+    layers = {layer.id: layer for layer in map_obj.layers.all()}
+    style_index = {}
+    styles = []
+    ids, xs, ys, style_ids = [], [], [], []
+    for poi_id, poi_x, poi_y, layer_id, color in rows:
+        key = (layer_id, color)
+        if key not in style_index:
+            layer = layers.get(layer_id)
+            style_index[key] = len(styles)
+            styles.append({
+                'layer': layer_id,
+                'name': layer.name if layer else None,
+                # Same fallback as PointOfInterest.display_color
+                'color': color or (layer.color if layer else '') or default_color,
+            })
+        ids.append(poi_id)
+        xs.append(poi_x)
+        ys.append(poi_y)
+        style_ids.append(style_index[key])
+
+    count = len(ids)
+    body = [
+        HEADER.pack(b'POIT', POI_TILE_FORMAT_VERSION, z, x, y, count),
+        typed_array('Q', ids),  # POI ids are 64-bit
+        typed_array('H', xs),
+        typed_array('H', ys),
+        typed_array('H', style_ids),
+        b'\0' * (2 * count % 4),
+        json.dumps(styles, separators=(',', ':')).encode(),
+    ]
+    return b''.join(body)
+
+
+def get_poi_tile(map_obj, z, x, y, default_color):
+    """Gzipped tile at the map's current POI revision, from the cache when possible."""
+    key = f'poi-tile:v{POI_TILE_FORMAT_VERSION}:{map_obj.pk}:{map_obj.poi_revision}:{z}:{x}:{y}'
+    data = cache.get(key)
+    if data is None:
+        data = gzip.compress(build_poi_tile(map_obj, z, x, y, default_color), compresslevel=6)
+        cache.set(key, data, POI_TILE_CACHE_TIMEOUT)
+    return data
@@ -0,0 +1,135 @@
+"""
+Full-text search on names and descriptions.
+Searchable models keep a generated tsvector column, search_vector,
+indexed with GIN. Postgres recomputes it whenever the row is written, so
+it can never go stale, and ?search= matches it instead of scanning every
+row with ILIKE.
+
+The 'simple' configuration splits words without stemming or stop words,
+so every word is searchable whatever the language of the map, and the
+last word typed matches as a prefix.
+
+POI name autocomplete uses pg_trgm instead, through a GIN trigram index
+on names: trigrams match partly typed and misspelled words alike.
+"""
+
+import hashlib
+import re
+
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, SearchVector, TrigramSimilarity, TrigramWordSimilarity,
+)
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models import F, Func, Q, Value
+
+from .spatial import POSITION_SCALE
+
+SEARCH_CONFIG = 'simple'
+SEARCH_VECTOR_FIELD = 'search_vector'
+SEARCH_WEIGHTS = 'ABCD'  # By position in the search fields, earlier fields rank higher
+
+# Letters and digits, the pieces Postgres splits words into as well
+WORD = re.compile(r'[^\W_]+')
+
+AUTOCOMPLETE_LIMIT = 10  # Suggestions returned by default
+AUTOCOMPLETE_MAX_LIMIT = 50
+AUTOCOMPLETE_MAX_LENGTH = 100  # Longer input is cut, no name prefix is that long
+AUTOCOMPLETE_CACHE_TIMEOUT = 60  # Hot prefixes, keyed by map POI revision so edits show at once
+
+
+def search_document(*fields):
+    """The tsvector expression of a search_vector column over fields."""
+    vector = SearchVector(fields[0], config=SEARCH_CONFIG, weight=SEARCH_WEIGHTS[0])
+    for field, weight in zip(fields[1:], SEARCH_WEIGHTS[1:]):
+        vector = vector + SearchVector(field, config=SEARCH_CONFIG, weight=weight)
+    return vector
+
+
+def vector_fields(model):
+    """Names of the fields covered by a model's search_vector column, empty without one."""
+    try:
+        expression = model._meta.get_field(SEARCH_VECTOR_FIELD).expression
+    except (FieldDoesNotExist, AttributeError):
+        return set()
+    names = set()
+    pending = [expression]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, F):
+            names.add(node.name)
+        else:
+            pending.extend(source for source in node.get_source_expressions() if source is not None)
+    return names
+
+
+def prefix_query(terms):
+    """
+    tsquery matching documents containing every word of terms, each as a
+    prefix, or None when the terms have no words.
+    """
+    words = [word for term in terms for word in WORD.findall(term.lower())]
+    if not words:
+        return None
+    return SearchQuery(' & '.join(f"'{word}':*" for word in words), config=SEARCH_CONFIG, search_type='raw')
+
+
+def search(queryset, terms):
+    """Matches for terms annotated with search_rank, or None when terms have no words."""
+    query = prefix_query(terms)
+    if query is None:
+        return None
+    return (
+        queryset
+        .filter(**{SEARCH_VECTOR_FIELD: query})
+        .annotate(search_rank=SearchRank(F(SEARCH_VECTOR_FIELD), query))
+    )
+
+
+class TrigramMatch(Func):
+    """
+    pg_trgm operators usable by a trigram index: `text <% column` for a
+    word of column similar to text, `text % column` for similar values.
+    """
+    output_field = models.BooleanField()
+    template = '(%(expressions)s)'
+
+    def __init__(self, text, column, operator):
+        # Doubled, as the SQL goes through parameter interpolation
+        self.arg_joiner = f' {operator.replace("%", "%%")} '
+        super().__init__(text, column)
+
+
+def normalize_prefix(text):
+    """Autocomplete input as matched: lowercase and single-spaced, like pg_trgm sees it."""
+    return ' '.join(text.lower().split())[:AUTOCOMPLETE_MAX_LENGTH]
+
+
+def autocomplete(map_obj, text, limit=AUTOCOMPLETE_LIMIT):
+    """
+    The limit POIs of a map whose names best match what was typed so far,
+    as {id, name, x_position, y_position}. A name matches when one of its
+    words is close to the text (a prefix or a typo) or the whole name is.
+    """
+    text = normalize_prefix(text)
+    if not text:
+        return []
+    digest = hashlib.sha256(text.encode()).hexdigest()[:32]
+    key = f'poi-autocomplete:{map_obj.pk}:{map_obj.poi_revision}:{limit}:{digest}'
+    suggestions = cache.get(key)
+    if suggestions is None:
+        query = Value(text)
+        rows = (
+            map_obj.points_of_interest
+            .filter(Q(TrigramMatch(query, F('name'), '<%')) | Q(TrigramMatch(query, F('name'), '%')))
+            .annotate(word_similarity=TrigramWordSimilarity(text, 'name'), similarity=TrigramSimilarity('name', text))
+            .order_by('-word_similarity', '-similarity', 'name', 'id')
+            .values_list('id', 'name', 'x_position', 'y_position')[:limit]
+        )
+        suggestions = [
+            {'id': poi_id, 'name': name, 'x_position': x / POSITION_SCALE, 'y_position': y / POSITION_SCALE}
+            for poi_id, name, x, y in rows
+        ]
+        cache.set(key, suggestions, AUTOCOMPLETE_CACHE_TIMEOUT)
+    return suggestions
@@ -2,9 +2,24 @@
 Serializers for the maps app.
 """
 
+import mimetypes
+from contextlib import contextmanager
+from decimal import Decimal
+
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import Map, MapLayer, PointOfInterest, SharedMap
+from django.urls import reverse
+from jobs.queue import jobs_for
+from jobs.serializers import JobSerializer
+from .display import DISPLAY_CONTENT_TYPE, display_path
+from .models import Map, MapLayer, PointOfInterest, SharedMap, ChunkedUpload
+from .pdf import DEFAULT_PAGE_RESOLUTION, PAGE_RESOLUTIONS
+from .poi_tiles import POI_TILE_MAX_ZOOM
+from .spatial import POSITION_SCALE
+from .thumbnails import THUMBNAIL_SIZES, thumbnail_path
+from .tiles import TILE_SIZE
+from .uploads import AssembledFile, received_chunks
 
 
 class UserMinimalSerializer(serializers.ModelSerializer):
@@ -14,12 +29,43 @@ class UserMinimalSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'email']
 
 
+class PositionField(serializers.DecimalField):
+    """
+    POI position in the API: a percentage with up to 3 decimals, stored
+    as an integer number of thousandths.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(max_digits=6, decimal_places=3, **kwargs)
+
+    def to_internal_value(self, data):
+        return int(super().to_internal_value(data) * POSITION_SCALE)
+
+    def to_representation(self, value):
+        return super().to_representation(Decimal(value) / POSITION_SCALE)
+
+
+def media_url(name, request=None):
+    """URL of a stored file, served through the access-checked media view."""
+    url = reverse('media', args=[name])
+    return request.build_absolute_uri(url) if request else url
+
+
+class MediaFileField(serializers.FileField):
+    """File field linking to the media view instead of the unprotected MEDIA_URL."""
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        return media_url(value.name, self.context.get('request'))
+
+
 class MapLayerSerializer(serializers.ModelSerializer):
     """
     Serializer for MapLayer model.
     Layers act as categories for POIs within a specific map.
     """
-    poi_count = serializers.ReadOnlyField()
+    poi_count = serializers.SerializerMethodField()
 
     class Meta:
         model = MapLayer
@@ -29,6 +75,11 @@ class MapLayerSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['created_at', 'updated_at']
 
+    def get_poi_count(self, obj):
+        # Callers that already counted the POIs pass {layer_id: count} as context
+        counts = self.context.get('poi_counts')
+        return counts[obj.id] if counts is not None else obj.poi_count
+
 
 class PointOfInterestSerializer(serializers.ModelSerializer):
     """Serializer for PointOfInterest model."""
@@ -42,6 +93,8 @@ class PointOfInterestSerializer(serializers.ModelSerializer):
     )
     created_by = UserMinimalSerializer(read_only=True)
     display_color = serializers.ReadOnlyField()
+    x_position = PositionField()
+    y_position = PositionField()
 
     class Meta:
         model = PointOfInterest
@@ -67,12 +120,39 @@ class PointOfInterestSerializer(serializers.ModelSerializer):
         return data
 
 
+class PointOfInterestBulkSerializer(serializers.ModelSerializer):
+    """
+    Serializer for one item of a bulk POI write.
+    The map is given once for the whole request, and layer ownership is
+    checked against context['layer_ids'] instead of one query per item.
+    """
+    layer_id = serializers.IntegerField(required=False, allow_null=True)
+    x_position = PositionField()
+    y_position = PositionField()
+
+    class Meta:
+        model = PointOfInterest
+        fields = ['name', 'description', 'layer_id', 'x_position', 'y_position', 'icon', 'color']
+
+    def validate_layer_id(self, value):
+        if value is not None and value not in self.context['layer_ids']:
+            raise serializers.ValidationError('Layer must belong to the same map as the point of interest.')
+        return value
+
+
 class PointOfInterestListSerializer(serializers.ModelSerializer):
-    """Lighter serializer for listing POIs."""
-    layer_id = serializers.IntegerField(source='layer.id', read_only=True, allow_null=True)
-    layer_name = serializers.CharField(source='layer.name', read_only=True, allow_null=True)
-    layer_color = serializers.CharField(source='layer.color', read_only=True, allow_null=True)
-    display_color = serializers.ReadOnlyField()
+    """
+    Lighter serializer for listing POIs.
+    Layer fields and display_color come from with_layer_fields(), so a
+    list costs one query whatever its length; querysets serialized with
+    it, nested ones included, must be annotated by it.
+    """
+    layer_id = serializers.IntegerField(read_only=True, allow_null=True)
+    layer_name = serializers.CharField(read_only=True, allow_null=True)
+    layer_color = serializers.CharField(read_only=True, allow_null=True)
+    display_color = serializers.CharField(source='list_display_color', read_only=True)
+    x_position = PositionField(read_only=True)
+    y_position = PositionField(read_only=True)
 
     class Meta:
         model = PointOfInterest
@@ -84,6 +164,17 @@ class PointOfInterestListSerializer(serializers.ModelSerializer):
         ]
 
 
+class PointOfInterestNearestSerializer(PointOfInterestListSerializer):
+    """POI list entry with its distance from the requested point."""
+    distance = serializers.SerializerMethodField()
+
+    class Meta(PointOfInterestListSerializer.Meta):
+        fields = PointOfInterestListSerializer.Meta.fields + ['distance']
+
+    def get_distance(self, obj):
+        return round(obj.distance, 3)
+
+
 class SharedMapSerializer(serializers.ModelSerializer):
     """Serializer for SharedMap model."""
     shared_with = UserMinimalSerializer(read_only=True)
@@ -141,58 +232,216 @@ class SharedMapUpdateSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'map', 'map_name', 'shared_with', 'shared_by', 'created_at', 'updated_at']
 
 
+class ChunkedUploadSerializer(serializers.ModelSerializer):
+    """Serializer for starting and inspecting a resumable chunked upload."""
+    chunk_size = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        max_value=settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE
+    )
+    size = serializers.IntegerField(min_value=1, max_value=settings.CHUNKED_UPLOAD_MAX_SIZE)
+    total_chunks = serializers.ReadOnlyField()
+    received_chunks = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ChunkedUpload
+        fields = [
+            'id', 'filename', 'content_type', 'size', 'chunk_size',
+            'total_chunks', 'received_chunks', 'sha256', 'status', 'created_at', 'updated_at'
+        ]
+        read_only_fields = ['id', 'sha256', 'status', 'created_at', 'updated_at']
+
+    def get_received_chunks(self, obj):
+        return received_chunks(obj)
+
+    def create(self, validated_data):
+        validated_data.setdefault('chunk_size', settings.CHUNKED_UPLOAD_CHUNK_SIZE)
+        return super().create(validated_data)
+
+
+def file_type_for(content_type):
+    """Classify an uploaded file as 'pdf' or 'image' from its content type."""
+    return 'pdf' if 'pdf' in (content_type or '') else 'image'
+
+
+class ChunkedUploadAttachMixin:
+    """
+    Lets a map serializer take its file from a completed chunked upload
+    through a write-only upload_id field instead of a multipart file.
+    """
+
+    def validate_upload_id(self, upload):
+        if upload and upload.owner != self.context['request'].user:
+            raise serializers.ValidationError('Upload not found.')
+        return upload
+
+    @contextmanager
+    def attached_upload(self, validated_data):
+        """
+        Move a completed upload into validated_data['file'] while the map is
+        saved, then delete the upload. Deleting it also removes the assembled
+        file when storage reused an identical blob instead of moving it.
+        """
+        upload = validated_data.pop('upload', None)
+        if upload is None:
+            yield None
+            return
+        with AssembledFile(upload) as file:
+            validated_data['file'] = file
+            yield upload
+        upload.delete()
+
+
 class MapListSerializer(serializers.ModelSerializer):
     """Serializer for listing maps (minimal data)."""
     owner = UserMinimalSerializer(read_only=True)
     poi_count = serializers.ReadOnlyField()
     layer_count = serializers.SerializerMethodField()
+    file = MediaFileField(read_only=True)
+    thumbnail = serializers.SerializerMethodField()
 
     class Meta:
         model = Map
         fields = [
-            'id', 'name', 'description', 'file', 'file_type', 'owner',
+            'id', 'name', 'description', 'file', 'file_type', 'owner', 'thumbnail',
             'is_public', 'poi_count', 'layer_count', 'created_at', 'updated_at'
         ]
 
     def get_layer_count(self, obj):
         return obj.layers.count()
 
+    def get_thumbnail(self, obj):
+        """Thumbnail URL per size, or None while thumbnails are not built."""
+        if not obj.has_thumbnails:
+            return None
+        request = self.context.get('request')
+        return {size: media_url(thumbnail_path(obj.file.name, size), request) for size in THUMBNAIL_SIZES}
 
-class MapSerializer(serializers.ModelSerializer):
+
+class MapSerializer(ChunkedUploadAttachMixin, serializers.ModelSerializer):
     """Full serializer for Map model."""
+    file = MediaFileField(required=False)
+    upload_id = serializers.PrimaryKeyRelatedField(
+        queryset=ChunkedUpload.objects.filter(status='complete'),
+        source='upload',
+        write_only=True,
+        required=False
+    )
     owner = UserMinimalSerializer(read_only=True)
     layers = MapLayerSerializer(many=True, read_only=True)
     points_of_interest = PointOfInterestListSerializer(many=True, read_only=True)
     shared_with = SharedMapSerializer(many=True, read_only=True)
     poi_count = serializers.ReadOnlyField()
+    image = serializers.SerializerMethodField()
+    tiles = serializers.SerializerMethodField()
+    poi_tiles = serializers.SerializerMethodField()
+    pages = serializers.SerializerMethodField()
+    jobs = serializers.SerializerMethodField()
 
     class Meta:
         model = Map
         fields = [
-            'id', 'name', 'description', 'file', 'file_type', 'owner',
+            'id', 'name', 'description', 'file', 'upload_id', 'file_type', 'owner',
             'width', 'height', 'is_public', 'layers', 'points_of_interest',
-            'shared_with', 'poi_count', 'created_at', 'updated_at'
+            'shared_with', 'poi_count', 'image', 'tiles', 'poi_tiles', 'pages', 'jobs', 'created_at', 'updated_at'
         ]
         read_only_fields = ['created_at', 'updated_at', 'owner', 'file_type']
 
+    def _detail_url(self, obj):
+        url = reverse('map-detail', args=[obj.pk])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def get_image(self, obj):
+        """
+        Variants of an image map. The url picks one by Accept header,
+        each variant can also be fetched directly.
+        """
+        if obj.file_type != 'image' or not obj.file:
+            return None
+        request = self.context.get('request')
+        variants = [{
+            'name': 'original',
+            'content_type': mimetypes.guess_type(obj.file.name)[0],
+            'url': media_url(obj.file.name, request),
+        }]
+        if obj.has_display_image:
+            variants.append({
+                'name': 'display',
+                'content_type': DISPLAY_CONTENT_TYPE,
+                'url': media_url(display_path(obj.file.name), request),
+            })
+        return {'url': self._detail_url(obj) + 'image/', 'variants': variants}
+
+    def get_tiles(self, obj):
+        """Tile pyramid description, or None while tiles are not built."""
+        if obj.tile_max_zoom is None:
+            return None
+        return {
+            'url': self._detail_url(obj) + 'tiles/{z}/{x}/{y}/',
+            'tile_size': TILE_SIZE,
+            'max_zoom': obj.tile_max_zoom,
+        }
+
+    def get_poi_tiles(self, obj):
+        """Binary POI tile description, see poi_tiles.py for the format."""
+        return {
+            'url': self._detail_url(obj) + 'poi-tiles/{z}/{x}/{y}/',
+            'max_zoom': POI_TILE_MAX_ZOOM,
+            'revision': obj.poi_revision,
+        }
+
+    def get_pages(self, obj):
+        """Rasterized PDF page description, or None for image maps."""
+        if obj.page_count is None:
+            return None
+        return {
+            'url': self._detail_url(obj) + 'pages/{page}/?resolution={resolution}',
+            'count': obj.page_count,
+            'sizes': obj.page_sizes,
+            'resolutions': PAGE_RESOLUTIONS,
+            'default_resolution': DEFAULT_PAGE_RESOLUTION,
+        }
+
+    def get_jobs(self, obj):
+        """Recent background jobs processing this map's file."""
+        return JobSerializer(jobs_for(obj)[:5], many=True).data
+
+    def validate(self, data):
+        if not self.instance and not (data.get('file') or data.get('upload')):
+            raise serializers.ValidationError({'file': 'Upload a file or provide a completed upload_id.'})
+        return data
+
     def create(self, validated_data):
         validated_data['owner'] = self.context['request'].user
+        with self.attached_upload(validated_data):
+            # Determine file type
+            file = validated_data.get('file')
+            if file:
+                validated_data['file_type'] = file_type_for(file.content_type)
 
-        # Determine file type
-        file = validated_data.get('file')
-        if file:
-            content_type = file.content_type
-            if 'pdf' in content_type:
-                validated_data['file_type'] = 'pdf'
-            else:
-                validated_data['file_type'] = 'image'
-
-        return super().create(validated_data)
+            return super().create(validated_data)
 
 
-class MapUpdateSerializer(serializers.ModelSerializer):
-    """Serializer for updating map details (without file)."""
+class MapUpdateSerializer(ChunkedUploadAttachMixin, serializers.ModelSerializer):
+    """
+    Serializer for updating map details.
+    The file can only be replaced through a completed chunked upload.
+    """
+    upload_id = serializers.PrimaryKeyRelatedField(
+        queryset=ChunkedUpload.objects.filter(status='complete'),
+        source='upload',
+        write_only=True,
+        required=False
+    )
 
     class Meta:
         model = Map
-        fields = ['name', 'description', 'width', 'height', 'is_public']
\ No newline at end of file
+        fields = ['name', 'description', 'width', 'height', 'is_public', 'upload_id']
+
+    def update(self, instance, validated_data):
+        with self.attached_upload(validated_data) as upload:
+            if upload:
+                validated_data['file_type'] = file_type_for(upload.content_type)
+
+            return super().update(instance, validated_data)
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+Spatial queries on POI positions.
+POIs are indexed by GiST indexes on (map, point(x_position, y_position))
+and (layer, point(...)), so viewport queries read only the index pages
+covering the requested area instead of every POI of the map, and nearest
+neighbour queries walk the index outwards from the requested point.
+
+Positions are stored as integers in thousandths of a percent, 0 to
+100000, so they are read without Decimal objects and computed on exactly.
+The API still takes and returns percentages.
+"""
+
+import math
+
+from django.db import models
+from django.db.models import F, Func, Value
+from django.db.models.functions import Cast, Power, Sqrt
+
+POSITION_SCALE = 1000  # Stored position units per percent
+NEAREST_K = 5  # POIs returned by default
+NEAREST_MAX_K = 100
+
+
+class PointField(models.Field):
+    """Output type of Postgres geometric point expressions."""
+
+    def db_type(self, connection):
+        return 'point'
+
+
+class MakePoint(Func):
+    """point(x, y) from two numeric expressions."""
+    function = 'point'
+    output_field = PointField()
+
+    def __init__(self, x, y):
+        super().__init__(Cast(x, models.FloatField()), Cast(y, models.FloatField()))
+
+
+class MakeBox(Func):
+    """box(corner, corner) from two points."""
+    function = 'box'
+    output_field = models.Field()
+
+
+class ContainedIn(Func):
+    """Geometric containment, `shape <@ container`."""
+    arg_joiner = ' <@ '
+    template = '(%(expressions)s)'
+    output_field = models.BooleanField()
+
+
+class Distance(Func):
+    """Distance between two points, `a <-> b`. Ordering by it walks a GiST index nearest first."""
+    arg_joiner = ' <-> '
+    template = '(%(expressions)s)'
+    output_field = models.FloatField()
+
+
+def poi_point():
+    """The indexed position expression. Queries must match it exactly to use the index."""
+    return MakePoint(F('x_position'), F('y_position'))
+
+
+def parse_bbox(value):
+    """
+    Parse 'x0,y0,x1,y1' into (min_x, min_y, max_x, max_y).
+    Corners may be given in any order. Raises ValueError when malformed.
+    """
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4 or not all(math.isfinite(part) for part in parts):
+        raise ValueError(value)
+    x0, y0, x1, y1 = parts
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def _filter_box(queryset, box):
+    # box in stored units
+    min_x, min_y, max_x, max_y = box
+    corners = MakePoint(Value(min_x), Value(min_y)), MakePoint(Value(max_x), Value(max_y))
+    return queryset.filter(ContainedIn(poi_point(), MakeBox(*corners)))
+
+
+def filter_bbox(queryset, bbox):
+    """Restrict a POI queryset to positions inside bbox, in percentages, edges included."""
+    return _filter_box(queryset, [value * POSITION_SCALE for value in bbox])
+
+
+def _scaled_distance(x, y, unit_x, unit_y):
+    # Distance in map units from a point in stored units
+    dx = (Cast(F('x_position'), models.FloatField()) - x) * unit_x
+    dy = (Cast(F('y_position'), models.FloatField()) - y) * unit_y
+    return Sqrt(Power(dx, 2) + Power(dy, 2))
+
+
+def nearest(queryset, x, y, k, width=None, height=None):
+    """
+    The k POIs of queryset nearest to (x, y), closest first, each with its
+    distance in map units when the map size is known, else in percentages.
+
+    The index orders by distance in percentages, which is not the real
+    distance on a map that is not square. So the k nearest in percentages
+    are fetched first; the real k nearest are all within the real distance
+    of the farthest of them, a box that the index then answers exactly.
+    """
+    # Map units per stored unit, along each axis
+    unit_x, unit_y = (width / 100, height / 100) if width and height else (1, 1)
+    unit_x, unit_y = unit_x / POSITION_SCALE, unit_y / POSITION_SCALE
+    x, y = x * POSITION_SCALE, y * POSITION_SCALE
+    origin = MakePoint(Value(x), Value(y))
+    candidates = list(queryset.annotate(distance=Distance(poi_point(), origin)).order_by('distance')[:k])
+
+    if unit_x == unit_y:
+        for poi in candidates:
+            poi.distance *= unit_x
+        return candidates
+
+    def distance(poi):
+        return math.hypot((poi.x_position - x) * unit_x, (poi.y_position - y) * unit_y)
+
+    if len(candidates) < k:
+        # Every POI is already here
+        for poi in candidates:
+            poi.distance = distance(poi)
+        return sorted(candidates, key=lambda poi: (poi.distance, poi.pk))
+
+    # Slightly widened so float rounding cannot leave the farthest candidate out
+    radius = max(distance(poi) for poi in candidates) * (1 + 1e-9)
+    box = [x - radius / unit_x, y - radius / unit_y, x + radius / unit_x, y + radius / unit_y]
+    return list(
+        _filter_box(queryset, box)
+        .annotate(distance=_scaled_distance(x, y, unit_x, unit_y))
+        .order_by('distance', 'pk')[:k]
+    )
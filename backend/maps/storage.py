@@ -0,0 +1,101 @@
+"""
+Content-addressed, deduplicating storage for map files.
+Uploads are hashed while they stream in and stored under their SHA-256,
+so byte-identical maps share one blob. Blobs are reference counted and
+only deleted when the last map using them lets go.
+"""
+
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_sha256(content):
+    """Return the SHA-256 of a Django File, reusing a digest computed during upload."""
+    digest = getattr(content, 'sha256', None)
+    if digest:
+        return digest
+
+    digest = hashlib.sha256()
+    for chunk in content.chunks(HASH_BLOCK_SIZE):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def blob_name(digest, filename):
+    """Content-addressed storage path, keeping the original extension."""
+    extension = os.path.splitext(filename)[1].lower()
+    return f'maps/blobs/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+
+class BlobExists(Exception):
+    """Another request stored the same blob while this one was saving it."""
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Filesystem storage that names files after their content.
+    Saving bytes that are already stored returns the existing name
+    without writing anything.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = blob_name(file_sha256(content), name)
+        try:
+            # Reused blobs count as new for the age check of gc_media
+            os.utime(self.path(name))
+            return name
+        except FileNotFoundError:
+            pass
+        try:
+            return self._save(name, content)
+        except BlobExists:
+            return name
+
+    def get_available_name(self, name, max_length=None):
+        # Only reached when _save finds the blob already written, and
+        # identical names mean identical bytes, so never pick a new one.
+        if self.exists(name):
+            raise BlobExists(name)
+        return name
+
+
+map_file_storage = ContentAddressedStorage()
+
+
+class HashingUploadHandlerMixin:
+    """Hashes file data as it streams through an upload handler."""
+
+    def new_file(self, *args, **kwargs):
+        # Set before super(), which may raise StopFutureHandlers
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
@@ -0,0 +1,111 @@
+"""
+Background tasks for the maps app.
+Derived data for map files is built by `manage.py runworker` instead of
+inside the web request that uploaded the file.
+"""
+
+import os
+
+from django.core.files.storage import default_storage
+
+from jobs.queue import task
+
+from .dimensions import read_map_dimensions
+from .display import build_display_image, delete_display_image
+from .models import Map, MapFileBlob
+from .pdf import delete_page_rasters, read_page_sizes
+from .storage import map_file_storage
+from .thumbnails import build_thumbnails, delete_thumbnails
+from .tiles import build_tile_pyramid, delete_tile_pyramid
+from .utils import delete_storage_tree
+
+# Seconds before its release that a reused blob is still spared: a save that
+# reused it commits its reference well within this, or gc_media cleans up
+BLOB_REUSE_GRACE = 5 * 60
+
+
+@task('maps.process_map_file')
+def process_map_file(map_id, file_name, keep_dimensions=False):
+    """
+    Build everything derived from a map file: dimensions, PDF page boxes,
+    the tile pyramid, the WebP display image and thumbnails.
+    """
+    map_obj = Map.objects.filter(pk=map_id).first()
+    if map_obj is None or map_obj.file.name != file_name:
+        return  # Deleted, or replaced and handled by a newer job
+
+    # Derived data of a previous file version, if any
+    delete_tile_pyramid(map_obj)
+    delete_page_rasters(map_obj)
+
+    updates = {'tile_max_zoom': None, 'page_count': None, 'page_sizes': [], 'has_display_image': False}
+    if map_obj.file_type == 'pdf':
+        # Pages themselves are rendered lazily, only the page boxes are read here
+        page_sizes = read_page_sizes(map_obj)
+        updates.update(page_count=len(page_sizes), page_sizes=page_sizes)
+        if page_sizes:
+            updates['width'], updates['height'] = (round(side) for side in page_sizes[0])
+    else:
+        # Header-only read, the pixel data is decoded by the tile builder
+        size = read_map_dimensions(map_obj.file.path, map_obj.file_type)
+        if size is not None:
+            updates['width'], updates['height'] = size
+        updates['tile_max_zoom'] = build_tile_pyramid(map_obj)
+        updates['has_display_image'] = build_display_image(map_obj)
+
+    build_thumbnails(map_obj)
+    updates['has_thumbnails'] = True
+
+    # Keep a coordinate space supplied by the client on create
+    if keep_dimensions:
+        updates.pop('width', None)
+        updates.pop('height', None)
+
+    Map.objects.filter(pk=map_id, file=file_name).update(**updates)
+
+
+@task('maps.build_display_image')
+def build_map_display_image(map_id, file_name):
+    """Build only the WebP display image, for maps uploaded before it existed."""
+    map_obj = Map.objects.filter(pk=map_id, file=file_name).first()
+    if map_obj is None:
+        return
+    has_display_image = build_display_image(map_obj)
+    Map.objects.filter(pk=map_id, file=file_name).update(has_display_image=has_display_image)
+
+
+def _touched_since(name, timestamp):
+    try:
+        return os.path.getmtime(map_file_storage.path(name)) >= timestamp
+    except FileNotFoundError:
+        return False
+
+
+@task('maps.delete_blobs')
+def delete_blobs(names=(), released=()):
+    """
+    Delete released map files and their derivatives, unless they are in use again.
+    released lists [name, release time] pairs. Saving a map touches a blob it
+    reuses before its reference is committed, so a blob touched after, or
+    just before, its release is kept; gc_media deletes it if nothing ever
+    refers to it.
+    """
+    released_at = dict.fromkeys(names)
+    for name, timestamp in released:
+        released_at[name] = min(timestamp, released_at.get(name) or timestamp)
+
+    in_use = set(MapFileBlob.objects.filter(name__in=released_at).values_list('name', flat=True))
+    in_use.update(Map.objects.filter(file__in=released_at).values_list('file', flat=True))
+    for name, timestamp in released_at.items():
+        if name in in_use or (timestamp is not None and _touched_since(name, timestamp - BLOB_REUSE_GRACE)):
+            continue
+        delete_thumbnails(name)
+        delete_display_image(name)
+        default_storage.delete(name)
+
+
+@task('maps.delete_storage_trees')
+def delete_storage_trees(paths):
+    """Delete directories of derived files, such as tiles and page rasters."""
+    for path in paths:
+        delete_storage_tree(path)
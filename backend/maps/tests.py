@@ -1,3 +1,842 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models.signals import pre_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from jobs.models import Job
+
+from .clusters import get_level
+from .media import normalized_name, parse_range
+from .pagination import KeysetPagination
+from .pdf import PdfRenderError, _run_in_pool
+from .poi_import import PoiImportError, import_rows, read_rows
+from .admin import PointOfInterestAdmin
+from .apps import convert_decimal_positions
+from .models import DEFAULT_POI_COLOR, ChunkedUpload, Map, MapFileBlob, MapLayer, PointOfInterest, SharedMap, Tombstone
+from .storage import map_file_storage
+from .tasks import BLOB_REUSE_GRACE, delete_blobs
+from .uploads import AssembledFile, upload_dir
+from .views import MediaView
+
+
+class ParseRangeTests(SimpleTestCase):
+
+    def test_whole_file(self):
+        for header in (None, '', 'bytes=-', 'items=0-1', 'bytes=0-1,4-5'):
+            self.assertIsNone(parse_range(header, 10))
+
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-3', 10), (0, 3))
+        self.assertEqual(parse_range('bytes=4-', 10), (4, 9))
+        self.assertEqual(parse_range('bytes=4-100', 10), (4, 9))
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_range('bytes=-100', 10), (0, 9))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=10-', 'bytes=5-4', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                parse_range(header, 10)
+
+
+class RenderPoolTests(SimpleTestCase):
+
+    def test_pool_recovers_from_a_dead_worker(self):
+        with self.assertRaises(PdfRenderError):
+            _run_in_pool(os._exit, 1)
+        self.assertEqual(_run_in_pool(abs, -3), 3)
+
+
+class NormalizedNameTests(SimpleTestCase):
+
+    def test_plain_names(self):
+        for name in ('maps/blobs/ab/cd/file.png', 'profile_pictures/user_1/me.jpg'):
+            self.assertEqual(normalized_name(name), name)
+
+    def test_names_that_move(self):
+        for name in (
+            '', '.', '..', '/etc/passwd', '../secret', 'maps/../../secret',
+            'profile_pictures/../maps/blobs/ab/cd/file.png', 'maps//blobs/file.png',
+            'maps/./blobs/file.png', 'maps/blobs/',
+        ):
+            self.assertIsNone(normalized_name(name), name)
+
+
+class MediaAccessTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='password')
+        cls.friend = User.objects.create_user('friend', password='password')
+        cls.stranger = User.objects.create_user('stranger', password='password')
+        cls.map = Map.objects.create(name='Private', file_type='image', owner=cls.owner)
+        # Set without saving through the model, which would queue processing
+        cls.name = 'maps/blobs/ab/cd/' + 'ab' * 32 + '.png'
+        Map.objects.filter(pk=cls.map.pk).update(file=cls.name)
+        SharedMap.objects.create(map=cls.map, shared_with=cls.friend, shared_by=cls.owner, permission='view')
+
+    def can_access(self, user, path):
+        return MediaView().can_access(user, path)
+
+    def test_map_file(self):
+        self.assertTrue(self.can_access(self.owner, self.name))
+        self.assertTrue(self.can_access(self.friend, self.name))
+        self.assertFalse(self.can_access(self.stranger, self.name))
+
+    def test_derivatives(self):
+        stem = self.name.rsplit('.', 1)[0]
+        folder, base = stem.rsplit('/', 1)
+        for path in (
+            f'{folder}/thumbnails/{base}_small.jpg',
+            f'{folder}/display/{base}.webp',
+            f'maps/user_{self.owner.pk}/tiles/map_{self.map.pk}/0/0_0.jpg',
+        ):
+            self.assertTrue(self.can_access(self.owner, path), path)
+            self.assertFalse(self.can_access(self.stranger, path), path)
+
+    def test_derivatives_of_a_similar_name(self):
+        # Older, non-deduplicated names: a.png is private, a.b.png is public
+        private = Map.objects.create(name='A', file_type='image', owner=self.owner)
+        public = Map.objects.create(name='A.B', file_type='image', owner=self.owner, is_public=True)
+        Map.objects.filter(pk=private.pk).update(file='maps/user_1/a.png')
+        Map.objects.filter(pk=public.pk).update(file='maps/user_1/a.b.png')
+        for path in ('maps/user_1/thumbnails/a_small.jpg', 'maps/user_1/display/a.webp'):
+            self.assertFalse(self.can_access(self.stranger, path), path)
+            self.assertTrue(self.can_access(self.owner, path), path)
+        for path in ('maps/user_1/thumbnails/a.b_small.jpg', 'maps/user_1/display/a.b.webp'):
+            self.assertTrue(self.can_access(self.stranger, path), path)
+
+    def test_profile_pictures(self):
+        self.assertTrue(self.can_access(self.stranger, 'profile_pictures/user_1/me.jpg'))
+
+    def test_traversal(self):
+        for path in (
+            f'profile_pictures/../{self.name}',
+            f'profile_pictures/x/../../{self.name}',
+            f'profile_pictures//../{self.name}',
+            f'maps/user_{self.owner.pk}/tiles/map_0/../../../../{self.name}',
+            f'/{self.name}',
+            '../backend/settings.py',
+            'profile_pictures/../../backend/settings.py',
+        ):
+            self.assertFalse(self.can_access(self.stranger, path), path)
+
+    def test_traversal_through_url(self):
+        path = f'profile_pictures/../{self.name}'
+        match = resolve(f'/api/maps/media/{path}')
+        self.assertIs(match.func.view_class, MediaView)
+        self.assertFalse(self.can_access(self.stranger, match.kwargs['path']))
+        client = APIClient()
+        client.force_authenticate(self.stranger)
+        self.assertEqual(client.get(f'/api/maps/media/{path}').status_code, 404)
+
+    def test_api_links_to_media_view(self):
+        Map.objects.filter(pk=self.map.pk).update(has_thumbnails=True, has_display_image=True)
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        data = client.get(f'/api/maps/maps/{self.map.pk}/').data
+        listed = client.get('/api/maps/my-maps/').data['results'][0]
+        urls = [data['file'], listed['file'], *listed['thumbnail'].values()]
+        urls += [variant['url'] for variant in data['image']['variants']]
+        for url in urls:
+            self.assertTrue(url.startswith('http://testserver/api/maps/media/maps/'), url)
+
+
+class MapJobsTests(TestCase):
+
+    def test_public_map_jobs_hide_tracebacks(self):
+        owner = User.objects.create_user('owner', password='password')
+        stranger = User.objects.create_user('stranger', password='password')
+        map_obj = Map.objects.create(name='Public', file_type='image', owner=owner, is_public=True)
+        Job.objects.create(
+            name='maps.process_map_file', target=map_obj, status='failed', attempts=5,
+            last_error='Traceback (most recent call last):\n  File "/srv/app/maps/tasks.py"',
+        )
+        client = APIClient()
+        client.force_authenticate(stranger)
+        jobs = client.get(f'/api/maps/maps/{map_obj.pk}/').data['jobs']
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual((jobs[0]['status'], jobs[0]['attempts']), ('failed', 5))
+        self.assertNotIn('last_error', jobs[0])
+        self.assertNotIn('Traceback', str(jobs))
+
+
+class PointOfInterestListQueryTests(TestCase):
+    """POI lists cost the same number of queries whatever their length."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='password')
+        cls.small = cls.create_map('Small', 2)
+        cls.large = cls.create_map('Large', 20)
+
+    @classmethod
+    def create_map(cls, name, count):
+        map_obj = Map.objects.create(name=name, file_type='image', owner=cls.user, width=1000, height=1000)
+        layers = [
+            MapLayer.objects.create(map=map_obj, name='Shops', color='#123456'),
+            MapLayer.objects.create(map=map_obj, name='Parks', color='#654321'),
+            None,
+        ]
+        for i in range(count):
+            PointOfInterest.objects.create(
+                name=f'POI {i}',
+                map=map_obj,
+                layer=layers[i % 3],
+                color='#ffffff' if i % 2 else '',
+                x_position=i * 1000,
+                y_position=i * 1000,
+                created_by=cls.user,
+            )
+        return map_obj
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data
+
+    def assert_constant_queries(self, url_for):
+        small, _ = self.count_queries(url_for(self.small))
+        large, data = self.count_queries(url_for(self.large))
+        self.assertEqual(small, large)
+        return data
+
+    def assert_display_fields(self, pois):
+        self.assertTrue(pois)
+        for data in pois:
+            poi = PointOfInterest.objects.select_related('layer').get(pk=data['id'])
+            self.assertIn('display_color', data)
+            self.assertEqual(data['display_color'], poi.display_color)
+            self.assertEqual(data['layer_id'], poi.layer_id)
+            self.assertEqual(data['layer_name'], poi.layer.name if poi.layer else None)
+            self.assertEqual(data['layer_color'], poi.layer.color if poi.layer else None)
+
+    def test_map_pois(self):
+        pois = self.assert_constant_queries(lambda map_obj: f'/api/maps/maps/{map_obj.pk}/pois/')
+        self.assertEqual(len(pois), 20)
+        self.assert_display_fields(pois)
+        self.assertIn(DEFAULT_POI_COLOR, {poi['display_color'] for poi in pois})
+
+    def test_map_pois_sorted_by_layer(self):
+        pois = self.assert_constant_queries(lambda map_obj: f'/api/maps/maps/{map_obj.pk}/pois/?sort_by=layer')
+        self.assert_display_fields(pois)
+
+    def test_poi_list(self):
+        page = self.assert_constant_queries(lambda map_obj: f'/api/maps/pois/?map={map_obj.pk}')
+        self.assert_display_fields(page['results'])
+
+    def test_poi_list_keyset_page(self):
+        page = self.assert_constant_queries(lambda map_obj: f'/api/maps/pois/?map={map_obj.pk}&cursor=')
+        self.assert_display_fields(page['results'])
+
+    def test_changes(self):
+        changes = self.assert_constant_queries(lambda map_obj: f'/api/maps/maps/{map_obj.pk}/changes/')
+        self.assert_display_fields(changes['points_of_interest'])
+
+    def test_nearest(self):
+        pois = self.assert_constant_queries(lambda map_obj: f'/api/maps/maps/{map_obj.pk}/pois/nearest/?x=50&y=50&k=10')
+        self.assert_display_fields(pois)
+
+    def test_map_detail(self):
+        data = self.assert_constant_queries(lambda map_obj: f'/api/maps/maps/{map_obj.pk}/')
+        self.assertEqual(len(data['points_of_interest']), 20)
+        self.assert_display_fields(data['points_of_interest'])
+
+    def test_by_layer(self):
+        groups = self.assert_constant_queries(lambda map_obj: f'/api/maps/pois/by_layer/?map={map_obj.pk}')
+        self.assert_display_fields([poi for group in groups for poi in group['points_of_interest']])
+
+    def test_by_layer_filtered(self):
+        shops = self.large.layers.get(name='Shops')
+        url = f'/api/maps/pois/by_layer/?map={self.large.pk}'
+        self.client.get(url)
+        groups = self.client.get(f'{url}&layer={shops.pk}').data
+        groups = {group['layer']['name']: group for group in groups}
+        self.assertEqual(sorted(groups), ['Parks', 'Shops'])
+        self.assertEqual(
+            sorted(poi['id'] for poi in groups['Shops']['points_of_interest']),
+            sorted(shops.points_of_interest.values_list('id', flat=True))
+        )
+        self.assertEqual(groups['Parks']['points_of_interest'], [])
+        self.assertEqual(groups['Parks']['layer']['poi_count'], 7)
+        self.assertEqual(self.client.get(f'{url}&layer=shops').status_code, 400)
+
+
+class PausedSave:
+    """
+    Save a POI in a thread that stops right before its row is written,
+    after the map revision was bumped, until resume() is called.
+    """
+
+    def __init__(self, poi):
+        self.poi = poi
+        self.paused = threading.Event()
+        self.resumed = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+
+    def pause(self, sender, instance, **kwargs):
+        if instance is self.poi:
+            self.paused.set()
+            self.resumed.wait(10)
+
+    def run(self):
+        try:
+            self.poi.save()
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        pre_save.connect(self.pause, sender=PointOfInterest)
+        self.thread.start()
+        assert self.paused.wait(10)
+        return self
+
+    def resume(self):
+        self.resumed.set()
+        self.thread.join(10)
+
+    def __exit__(self, *exc_info):
+        self.resume()
+        pre_save.disconnect(self.pause, sender=PointOfInterest)
+
+
+class RevisionAtomicityTests(TransactionTestCase):
+    """A revision bump commits together with the write that caused it."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner', password='password')
+        self.map = Map.objects.create(name='Map', file_type='image', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def new_poi(self):
+        return PointOfInterest(name='New', map=self.map, x_position=0, y_position=0, created_by=self.user)
+
+    def changes(self, since=None):
+        url = f'/api/maps/maps/{self.map.pk}/changes/'
+        return self.client.get(url if since is None else f'{url}?since={since}').data
+
+    def test_changes_never_skip_a_write_in_progress(self):
+        PointOfInterest.objects.create(name='Old', map=self.map, x_position=0, y_position=0, created_by=self.user)
+        cursor = self.changes()['cursor']
+        poi = self.new_poi()
+        with PausedSave(poi) as save:
+            during = self.changes(cursor)
+            self.assertEqual(during['points_of_interest'], [])
+            save.resume()
+        after = self.changes(during['cursor'])
+        self.assertEqual([item['id'] for item in after['points_of_interest']], [poi.pk])
+
+    def test_failed_save_keeps_the_revision(self):
+        revision = Map.objects.get(pk=self.map.pk).poi_revision
+        poi = self.new_poi()
+        poi.created_by_id = 0  # Rejected by the foreign key once the row is written
+        with self.assertRaises(IntegrityError):
+            poi.save()
+        self.assertEqual(Map.objects.get(pk=self.map.pk).poi_revision, revision)
+
+    def test_delete_and_tombstone_share_the_revision(self):
+        poi = PointOfInterest.objects.create(name='Gone', map=self.map, x_position=0, y_position=0, created_by=self.user)
+        poi_id, cursor = poi.pk, self.changes()['cursor']
+        poi.delete()
+        after = self.changes(cursor)
+        self.assertEqual(after['deleted']['points_of_interest'], [poi_id])
+        self.assertEqual(int(after['cursor']), int(cursor) + 1)
+
+
+class ClusterLevelRaceTests(TransactionTestCase):
+    """A cluster level built during a POI save matches its revision."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('owner', password='password')
+        self.map = Map.objects.create(name='Map', file_type='image', owner=self.user)
+        PointOfInterest.objects.create(name='Old', map=self.map, x_position=0, y_position=0, created_by=self.user)
+
+    def count(self, level):
+        return sum(entry[0] for groups in level['cells'].values() for entry in groups.values())
+
+    def test_level_built_during_a_save(self):
+        stale_map = Map.objects.get(pk=self.map.pk)
+        poi = PointOfInterest(name='New', map=self.map, x_position=50000, y_position=50000, created_by=self.user)
+
+        def build():
+            try:
+                get_level(stale_map, 0)
+            finally:
+                connection.close()
+
+        with PausedSave(poi) as save:
+            builder = threading.Thread(target=build)
+            builder.start()
+            builder.join(0.5)
+            save.resume()
+            builder.join(10)
+
+        current = Map.objects.get(pk=self.map.pk)
+        level = get_level(current, 0)
+        self.assertEqual(level['revision'], current.poi_revision)
+        self.assertEqual(self.count(level), 2)
+
+        PointOfInterest.objects.create(name='Later', map=self.map, x_position=1000, y_position=1000, created_by=self.user)
+        self.assertEqual(self.count(get_level(Map.objects.get(pk=self.map.pk), 0)), 3)
+
+
+class BulkPointOfInterestDeleteTests(TestCase):
+    """Deletes that skip PointOfInterest.delete() still reach the feed and caches."""
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('owner', password='password')
+        self.helper = User.objects.create_user('helper', password='password')
+        self.map = Map.objects.create(name='Map', file_type='image', owner=self.owner)
+        SharedMap.objects.create(map=self.map, shared_with=self.helper, shared_by=self.owner, permission='edit')
+        self.kept = self.create_poi('Kept', self.owner)
+        self.added = [self.create_poi(f'Added {i}', self.helper) for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def create_poi(self, name, user):
+        return PointOfInterest.objects.create(name=name, map=self.map, x_position=1000, y_position=1000, created_by=user)
+
+    def changes(self, since=None):
+        url = f'/api/maps/maps/{self.map.pk}/changes/'
+        return self.client.get(url if since is None else f'{url}?since={since}').data
+
+    def by_layer_ids(self):
+        groups = self.client.get(f'/api/maps/pois/by_layer/?map={self.map.pk}').data
+        return sorted(poi['id'] for group in groups for poi in group['points_of_interest'])
+
+    def cluster_count(self):
+        level = get_level(Map.objects.get(pk=self.map.pk), 0)
+        return sum(entry[0] for groups in level['cells'].values() for entry in groups.values())
+
+    def assert_recorded(self, delete):
+        cursor = self.changes()['cursor']
+        self.assertEqual(len(self.by_layer_ids()), 4)
+        self.assertEqual(self.cluster_count(), 4)
+        deleted_ids = sorted(poi.pk for poi in self.added)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            delete()
+
+        changes = self.changes(cursor)
+        self.assertEqual(int(changes['cursor']), int(cursor) + 1)
+        self.assertEqual(sorted(changes['deleted']['points_of_interest']), deleted_ids)
+        self.assertEqual(self.by_layer_ids(), [self.kept.pk])
+        self.assertEqual(self.cluster_count(), 1)
+
+    def test_user_cascade(self):
+        self.assert_recorded(self.helper.delete)
+        self.assertFalse(Tombstone.objects.filter(object_id=self.kept.pk).exists())
+
+    def test_admin_delete_selected(self):
+        admin = PointOfInterestAdmin(PointOfInterest, AdminSite())
+        self.assert_recorded(lambda: admin.delete_queryset(None, PointOfInterest.objects.filter(created_by=self.helper)))
+
+
+@override_settings(JOBS_RUN_INLINE=False)
+class DeleteBlobsTests(TestCase):
+    """A released blob saved again before its delete job runs is kept."""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.name = map_file_storage.save('scan.png', ContentFile(b'scan'))
+        MapFileBlob.acquire(self.name)
+
+    def release(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            MapFileBlob.release(self.name)
+        return Job.objects.get(name='maps.delete_blobs').payload
+
+    def test_released_blob_is_deleted(self):
+        payload = self.release()
+        age = time.time() - 2 * BLOB_REUSE_GRACE
+        os.utime(map_file_storage.path(self.name), (age, age))
+        delete_blobs(**payload)
+        self.assertFalse(map_file_storage.exists(self.name))
+
+    def test_blob_reused_before_the_job_runs(self):
+        payload = self.release()
+        self.assertEqual(map_file_storage.save('copy.png', ContentFile(b'scan')), self.name)
+        delete_blobs(**payload)
+        self.assertTrue(map_file_storage.exists(self.name))
+
+    def test_jobs_queued_with_names_only(self):
+        MapFileBlob.objects.filter(name=self.name).delete()
+        delete_blobs(names=[self.name])
+        self.assertFalse(map_file_storage.exists(self.name))
+
+
+class PoiImportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='password')
+        cls.map = Map.objects.create(name='Map', file_type='image', owner=cls.owner)
+        MapLayer.objects.create(map=cls.map, name='Shops')
+
+    def rows(self, content, file_format, columns=None):
+        return list(read_rows(io.BytesIO(content.encode()), file_format, columns))
+
+    def import_file(self, content, file_format, columns=None):
+        events = list(import_rows(self.map, self.owner, read_rows(io.BytesIO(content.encode()), file_format, columns)))
+        return events[-1]['done']
+
+    def test_csv_default_columns(self):
+        rows = self.rows('\ufefftitle,x,y,category\nCafe,10.5,20,Shops\n', 'csv')
+        self.assertEqual([values for _, values in rows], [
+            {'name': 'Cafe', 'x_position': '10.5', 'y_position': '20', 'layer': 'Shops'},
+        ])
+
+    def test_csv_column_mapping(self):
+        rows = self.rows('label,east,north\nCafe,1,2\n', 'csv', {'name': 'label', 'x_position': 'east', 'y_position': 'north'})
+        self.assertEqual(rows[0][1], {'name': 'Cafe', 'x_position': '1', 'y_position': '2'})
+
+    def test_csv_header_errors(self):
+        with self.assertRaisesMessage(PoiImportError, 'No column found for: x_position, y_position.'):
+            self.rows('name,lat,lon\nCafe,1,2\n', 'csv')
+        with self.assertRaisesMessage(PoiImportError, "Column 'east' mapped to x_position is missing."):
+            self.rows('name,x,y\n', 'csv', {'x_position': 'east'})
+        with self.assertRaisesMessage(PoiImportError, 'Unknown fields in column mapping: owner.'):
+            self.rows('name,x,y\n', 'csv', {'owner': 'name'})
+
+    def test_geojson_features(self):
+        content = json.dumps({
+            'type': 'FeatureCollection',
+            'name': 'pois',
+            'features': [
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [1.25, 2.5]}, 'properties': {'name': 'Cafe'}},
+                {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': []}, 'properties': {'name': 'Road'}},
+            ],
+        })
+        rows = [values for _, values in self.rows(content, 'geojson')]
+        self.assertEqual(rows, [{'name': 'Cafe', 'x_position': 1.25, 'y_position': 2.5}, {'name': 'Road', 'geometry': None}])
+
+    def test_invalid_geojson(self):
+        with self.assertRaisesMessage(PoiImportError, "Invalid GeoJSON: expected '{'."):
+            self.rows('[]', 'geojson')
+        with self.assertRaisesMessage(PoiImportError, 'Invalid GeoJSON: features must be a list.'):
+            self.rows('{"features": {}}', 'geojson')
+
+    def test_import_rows(self):
+        result = self.import_file('name,x,y,layer\nCafe,1.0004,2,Shops\nBar,3,4,Bars\n,5,6,\nPark,7,8,\n', 'csv')
+        self.assertEqual((result['rows'], result['imported'], result['rejected']), (4, 3, 1))
+        self.assertEqual(result['layers_created'], ['Bars'])
+        self.assertEqual(result['rejects'][0]['row'], 3)
+        self.assertIn('name', result['rejects'][0]['errors'])
+
+        pois = {poi.name: poi for poi in self.map.points_of_interest.select_related('layer')}
+        self.assertEqual((pois['Cafe'].x_position, pois['Cafe'].y_position), (1000, 2000))
+        self.assertEqual((pois['Cafe'].layer.name, pois['Bar'].layer.name, pois['Park'].layer), ('Shops', 'Bars', None))
+
+    def test_unreadable_file_keeps_imported_rows(self):
+        content = json.dumps({'features': [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [1, 2]}, 'properties': {'name': 'Cafe'}},
+        ]})[:-2] + 'x'
+        result = self.import_file(content, 'geojson')
+        self.assertEqual((result['imported'], result['error']), (1, 'Invalid GeoJSON.'))
+
+    def test_upload_is_spooled_to_disk(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        upload = SimpleUploadedFile('pois.csv', b'name,x,y\nCafe,1,2\n')
+        with mock.patch('maps.views.read_rows', wraps=read_rows) as wrapped:
+            response = client.post(f'/api/maps/maps/{self.map.pk}/import/', {'file': upload})
+            lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertIsInstance(wrapped.call_args.args[0], TemporaryUploadedFile)
+        self.assertEqual(lines[-1]['done']['imported'], 1)
+
+
+class ChunkedUploadTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='password')
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(
+            MEDIA_ROOT=media_root.name,
+            CHUNKED_UPLOAD_ROOT=os.path.join(media_root.name, 'chunked_uploads'),
+            JOBS_RUN_INLINE=False,
+        ))
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def upload(self, content, complete=True):
+        data = self.client.post('/api/maps/uploads/', {
+            'filename': 'scan.png', 'content_type': 'image/png', 'size': len(content),
+        }).data
+        self.client.put(
+            f'/api/maps/uploads/{data["id"]}/chunks/0/', content, content_type='application/octet-stream',
+            HTTP_X_CHUNK_SHA256=hashlib.sha256(content).hexdigest()
+        )
+        if complete:
+            self.assertEqual(self.client.post(f'/api/maps/uploads/{data["id"]}/complete/').data['status'], 'complete')
+        return ChunkedUpload.objects.get(pk=data['id'])
+
+    def test_reused_blob_leaves_nothing_behind(self):
+        name = map_file_storage.save('scan.png', ContentFile(b'scan'))
+        upload = self.upload(b'scan')
+        opened = []
+
+        def open_assembled(*args):
+            opened.append(AssembledFile(*args))
+            return opened[-1]
+
+        with mock.patch('maps.serializers.AssembledFile', side_effect=open_assembled):
+            response = self.client.post('/api/maps/maps/', {'name': 'Scan', 'upload_id': str(upload.pk)})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(Map.objects.get(pk=response.data['id']).file.name, name)
+        self.assertTrue(opened[0].closed)
+        self.assertFalse(os.path.exists(upload_dir(upload)))
+        self.assertFalse(ChunkedUpload.objects.filter(pk=upload.pk).exists())
+
+    def test_complete_locks_the_upload(self):
+        upload = self.upload(b'scan', complete=False)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(f'/api/maps/uploads/{upload.pk}/complete/')
+        self.assertTrue(any('FOR UPDATE' in query['sql'] for query in queries))
+
+    def test_gc_media_expires_idle_uploads(self):
+        idle = self.upload(b'idle', complete=False)
+        resumed = self.upload(b'resumed', complete=False)
+        recent = self.upload(b'recent')
+        long_ago = timezone.now() - timedelta(days=30)
+        ChunkedUpload.objects.filter(pk__in=[idle.pk, resumed.pk]).update(updated_at=long_ago)
+        os.utime(os.path.join(upload_dir(idle), '0.part'), (long_ago.timestamp(), long_ago.timestamp()))
+
+        call_command('gc_media', stdout=io.StringIO())
+        self.assertEqual(
+            set(ChunkedUpload.objects.values_list('pk', flat=True)),
+            {resumed.pk, recent.pk}
+        )
+        self.assertFalse(os.path.exists(upload_dir(idle)))
+
+
+class PoiBinaryFormatTests(TestCase):
+    """Packed POI ids hold the full range of the 64-bit primary key."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='password')
+        cls.map = Map.objects.create(name='Map', file_type='image', owner=cls.owner)
+        cls.ids = [5, 2 ** 32 + 7]
+        for poi_id in cls.ids:
+            PointOfInterest.objects.create(
+                id=poi_id, name=f'POI {poi_id}', map=cls.map, x_position=1000, y_position=2000, created_by=cls.owner
+            )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def unpack_ids(self, data, header):
+        count = header.unpack_from(data)[-1]
+        ids = array('Q', data[header.size:header.size + 8 * count])
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        return sorted(ids)
+
+    def test_columnar_binary(self):
+        data = self.client.get(f'/api/maps/maps/{self.map.pk}/pois/?format=columnar-binary').content
+        self.assertEqual(data[:4], b'POIC')
+        self.assertEqual(self.unpack_ids(data, struct.Struct('<4sHxxIxxxx')), self.ids)
+
+    def test_poi_tile(self):
+        data = self.client.get(f'/api/maps/maps/{self.map.pk}/poi-tiles/0/0/0/').content
+        self.assertEqual(data[:4], b'POIT')
+        self.assertEqual(self.unpack_ids(data, struct.Struct('<4sHHIIIxxxx')), self.ids)
+
+
+class BulkPointOfInterestTests(TestCase):
+    """The bulk action saves everything under one revision, or nothing."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='password')
+        cls.map = Map.objects.create(name='Map', file_type='image', owner=cls.owner)
+        cls.kept = PointOfInterest.objects.create(name='Kept', map=cls.map, x_position=1000, y_position=1000, created_by=cls.owner)
+        cls.gone = PointOfInterest.objects.create(name='Gone', map=cls.map, x_position=2000, y_position=2000, created_by=cls.owner)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.revision = Map.objects.get(pk=self.map.pk).poi_revision
+
+    def bulk(self, **operations):
+        return self.client.post('/api/maps/pois/bulk/', {'map': self.map.pk, **operations}, format='json')
+
+    def operations(self):
+        return {
+            'create': [{'name': 'New', 'x_position': 10, 'y_position': 20}],
+            'update': [{'id': self.kept.pk, 'name': 'Renamed'}],
+            'delete': [self.gone.pk],
+        }
+
+    def assert_unchanged(self):
+        self.assertEqual(Map.objects.get(pk=self.map.pk).poi_revision, self.revision)
+        self.assertEqual(sorted(self.map.points_of_interest.values_list('name', flat=True)), ['Gone', 'Kept'])
+        self.assertFalse(Tombstone.objects.filter(object_id=self.gone.pk).exists())
+
+    def test_one_revision_for_the_request(self):
+        response = self.bulk(**self.operations())
+        self.assertEqual(response.status_code, 200, response.data)
+
+        revision = Map.objects.get(pk=self.map.pk).poi_revision
+        self.assertEqual(revision, self.revision + 1)
+        pois = {poi.name: poi for poi in self.map.points_of_interest.all()}
+        self.assertEqual(sorted(pois), ['New', 'Renamed'])
+        self.assertEqual({poi.revision for poi in pois.values()}, {revision})
+        self.assertEqual(Tombstone.objects.get(object_id=self.gone.pk).revision, revision)
+
+    def test_invalid_item_saves_nothing(self):
+        operations = self.operations()
+        operations['create'].append({'name': 'No position'})
+        response = self.bulk(**operations)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['create'][0], {})
+        self.assertIn('x_position', response.data['create'][1])
+        self.assert_unchanged()
+
+    def test_unknown_id_saves_nothing(self):
+        operations = self.operations()
+        operations['delete'].append(self.gone.pk + 1000)
+        response = self.bulk(**operations)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['delete'][1], {'id': ['Point of interest not found on this map.']})
+        self.assert_unchanged()
+
+    def test_failed_write_rolls_back(self):
+        with mock.patch.object(PointOfInterest.objects, 'bulk_update', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.bulk(**self.operations())
+        self.assert_unchanged()
+
+
+@mock.patch.object(KeysetPagination, 'page_size', 3)
+class KeysetPaginationTests(TestCase):
+    """Cursors walk every row once in both directions, ties broken by id."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='password')
+        cls.map = Map.objects.create(name='Map', file_type='image', owner=cls.owner)
+        for i in range(8):
+            PointOfInterest.objects.create(name=f'POI {i}', map=cls.map, x_position=0, y_position=0, created_by=cls.owner)
+        # Three timestamps shared by several rows, so pages split inside ties
+        start = timezone.now()
+        for poi in cls.map.points_of_interest.all():
+            PointOfInterest.objects.filter(pk=poi.pk).update(created_at=start + timedelta(seconds=poi.pk % 3))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def expected(self, descending):
+        ordering = ['-created_at', '-id'] if descending else ['created_at', 'id']
+        return list(self.map.points_of_interest.order_by(*ordering).values_list('id', flat=True))
+
+    def walk(self, url, link):
+        """Pages of ids from url, following the next or previous links."""
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.data)
+            pages.append([poi['id'] for poi in response.data['results']])
+            url = response.data[link]
+        return pages
+
+    def assert_round_trip(self, ordering, descending):
+        pages = self.walk(f'/api/maps/pois/?map={self.map.pk}&ordering={ordering}&cursor=', 'next')
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual([pk for page in pages for pk in page], self.expected(descending))
+
+        last = self.client.get(f'/api/maps/pois/?map={self.map.pk}&ordering={ordering}&cursor=')
+        for _ in range(len(pages) - 1):
+            last = self.client.get(last.data['next'])
+        self.assertIsNone(last.data['next'])
+        self.assertEqual(self.walk(last.data['previous'], 'previous'), pages[-2::-1])
+
+    def test_descending(self):
+        self.assert_round_trip('-created_at', descending=True)
+
+    def test_ascending(self):
+        self.assert_round_trip('created_at', descending=False)
+
+    def test_invalid_cursors(self):
+        url = f'/api/maps/pois/?map={self.map.pk}'
+        self.assertEqual(self.client.get(f'{url}&cursor=garbage').status_code, 404)
+        next_link = self.client.get(f'{url}&cursor=').data['next']
+        cursor = parse_qs(urlsplit(next_link).query)['cursor'][0]
+        self.assertEqual(self.client.get(f'{url}&ordering=created_at&cursor={cursor}').status_code, 404)
+        self.assertEqual(self.client.get(f'{url}&ordering=name&cursor=').status_code, 400)
+
+
+class ConvertDecimalPositionsTests(TestCase):
+    """Decimal percentages become integer thousandths, once."""
+
+    def setUp(self):
+        owner = User.objects.create_user('owner', password='password')
+        map_obj = Map.objects.create(name='Map', file_type='image', owner=owner)
+        self.poi = PointOfInterest.objects.create(name='POI', map=map_obj, x_position=0, y_position=0, created_by=owner)
+        table = PointOfInterest._meta.db_table
+        with connection.cursor() as cursor:
+            # Run the deferred foreign key checks of the inserts, which would block ALTER TABLE
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute(
+                f'ALTER TABLE {table} ALTER COLUMN x_position TYPE numeric, ALTER COLUMN y_position TYPE numeric'
+            )
+            cursor.execute(f'UPDATE {table} SET x_position = 12.3456, y_position = 99.9994 WHERE id = %s', [self.poi.pk])
+
+    def column_types(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = current_schema() "
+                "AND table_name = %s AND column_name IN ('x_position', 'y_position')",
+                [PointOfInterest._meta.db_table]
+            )
+            return dict(cursor.fetchall())
+
+    def test_converts_once(self):
+        convert_decimal_positions(using='default')
+        self.assertEqual(self.column_types(), {'x_position': 'integer', 'y_position': 'integer'})
+        poi = PointOfInterest.objects.get(pk=self.poi.pk)
+        self.assertEqual((poi.x_position, poi.y_position), (12346, 99999))
+
+        with CaptureQueriesContext(connection) as queries:
+            convert_decimal_positions(using='default')
+        self.assertFalse([query for query in queries if 'ALTER' in query['sql']])
+        poi = PointOfInterest.objects.get(pk=self.poi.pk)
+        self.assertEqual((poi.x_position, poi.y_position), (12346, 99999))
@@ -0,0 +1,75 @@
+"""
+Fixed-size thumbnails for map cards.
+Thumbnails are generated once per file version and stored beside the
+original, so list endpoints never send the full-size map.
+"""
+
+import posixpath
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from .pdf import get_page_raster
+
+# Bounding box, in pixels, of each thumbnail size
+THUMBNAIL_SIZES = {
+    'small': 128,
+    'medium': 256,
+    'large': 512,
+}
+
+
+def thumbnail_path(file_name, size):
+    """Storage path of a thumbnail, next to the map file it was made from."""
+    directory, base = posixpath.split(file_name)
+    stem = posixpath.splitext(base)[0]
+    return f'{directory}/thumbnails/{stem}_{size}.jpg'
+
+
+def build_thumbnails(map_obj):
+    """
+    Generate every thumbnail size for the current file of a map.
+    Maps sharing a deduplicated file share its thumbnails, so existing
+    ones are kept.
+    """
+    names = [thumbnail_path(map_obj.file.name, size) for size in THUMBNAIL_SIZES]
+    if all(default_storage.exists(name) for name in names):
+        return
+    delete_thumbnails(map_obj.file.name)
+
+    if map_obj.file_type == 'pdf':
+        source = default_storage.open(get_page_raster(map_obj, 1, 'small'), 'rb')
+    else:
+        source = map_obj.file.open('rb')
+
+    with source, Image.open(source) as image:
+        # thumbnail() decodes JPEGs at a reduced scale through draft mode
+        image.thumbnail((max(THUMBNAIL_SIZES.values()),) * 2)
+        image = _flatten(image)
+
+    # Largest first, so each size is downscaled from the previous one
+    for size, side in sorted(THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+        image.thumbnail((side, side))
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=85, optimize=True)
+        default_storage.save(thumbnail_path(map_obj.file.name, size), ContentFile(buffer.getvalue()))
+
+
+def _flatten(image):
+    """Convert to RGB, compositing any transparency onto white."""
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def delete_thumbnails(file_name):
+    """Remove the thumbnails generated from a map file."""
+    if not file_name:
+        return
+    for size in THUMBNAIL_SIZES:
+        default_storage.delete(thumbnail_path(file_name, size))
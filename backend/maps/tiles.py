@@ -0,0 +1,83 @@
+"""
+Deep-zoom tile pyramid for map images.
+Cuts Map.file into fixed-size tiles at every zoom level so clients only
+fetch the part of the map that is in their viewport.
+"""
+
+import math
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from .utils import delete_storage_tree
+
+TILE_SIZE = 256
+TILE_FORMAT = 'PNG'
+TILE_CONTENT_TYPE = 'image/png'
+TILE_EXTENSION = 'png'
+
+
+def tiles_dir(map_obj):
+    """Storage directory holding the tile pyramid of a map."""
+    return f'maps/user_{map_obj.owner_id}/tiles/map_{map_obj.pk}'
+
+
+def tile_path(map_obj, z, x, y):
+    """Storage path of a single tile."""
+    return f'{tiles_dir(map_obj)}/{z}/{x}_{y}.{TILE_EXTENSION}'
+
+
+def max_zoom_for_size(width, height):
+    """Return the deepest zoom level, where one pixel maps to one image pixel."""
+    longest = max(width, height, 1)
+    return max(0, math.ceil(math.log2(longest / TILE_SIZE)))
+
+
+def build_tile_pyramid(map_obj):
+    """
+    Build the tile pyramid for a map image.
+    Level max_zoom is the full-resolution image; every level above it is
+    downsampled by half. Returns the max zoom level.
+    The image is decoded whole, and Pillow keeps 4 bytes per RGB(A) pixel,
+    so memory peaks at about 5 bytes per pixel while the first reduced
+    level is made (see MAP_IMAGE_MAX_PIXELS). Only one level is kept after.
+    """
+    delete_tile_pyramid(map_obj)
+
+    with map_obj.file.open('rb') as f:
+        level = Image.open(f)
+        level.load()
+
+    if level.mode not in ('RGB', 'RGBA'):
+        level = level.convert('RGBA' if 'A' in level.getbands() else 'RGB')
+
+    max_zoom = max_zoom_for_size(*level.size)
+    for z in range(max_zoom, -1, -1):
+        _save_level_tiles(map_obj, level, z)
+        if z > 0:
+            level = level.reduce(2)
+
+    return max_zoom
+
+
+def _save_level_tiles(map_obj, level, z):
+    """Cut one zoom level into tiles and write them to storage."""
+    width, height = level.size
+    for x in range(math.ceil(width / TILE_SIZE)):
+        for y in range(math.ceil(height / TILE_SIZE)):
+            box = (
+                x * TILE_SIZE,
+                y * TILE_SIZE,
+                min((x + 1) * TILE_SIZE, width),
+                min((y + 1) * TILE_SIZE, height),
+            )
+            buffer = BytesIO()
+            level.crop(box).save(buffer, format=TILE_FORMAT, optimize=True)
+            default_storage.save(tile_path(map_obj, z, x, y), ContentFile(buffer.getvalue()))
+
+
+def delete_tile_pyramid(map_obj):
+    """Remove every stored tile of a map."""
+    delete_storage_tree(tiles_dir(map_obj))
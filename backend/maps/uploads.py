@@ -0,0 +1,147 @@
+"""
+Resumable chunked uploads for large map files.
+Chunks are streamed straight to disk and verified against a SHA-256
+checksum, then assembled with kernel-side copies so the file never passes
+back through Python memory.
+"""
+
+import hashlib
+import os
+import shutil
+
+from django.conf import settings
+from django.core.files import File
+
+STREAM_BLOCK_SIZE = 64 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class ChunkError(Exception):
+    """Raised when a chunk is incomplete, oversized or fails its checksum."""
+
+
+def upload_dir(upload):
+    """Directory holding the chunks and assembled file of an upload."""
+    return os.path.join(settings.CHUNKED_UPLOAD_ROOT, str(upload.pk))
+
+
+def chunk_path(upload, index):
+    return os.path.join(upload_dir(upload), f'{index}.part')
+
+
+def assembled_path(upload):
+    return os.path.join(upload_dir(upload), 'assembled')
+
+
+def received_chunks(upload):
+    """Return the sorted indexes of chunks already stored on disk."""
+    try:
+        names = os.listdir(upload_dir(upload))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-len('.part')]) for name in names if name.endswith('.part'))
+
+
+def write_chunk(upload, index, stream, checksum):
+    """
+    Stream one chunk from the request body to disk.
+    The chunk is written to a temporary file and only renamed into place
+    once its size and SHA-256 checksum match, so a dropped connection
+    never leaves a partial chunk behind.
+    """
+    expected_size = upload.chunk_length(index)
+    os.makedirs(upload_dir(upload), exist_ok=True)
+    final_path = chunk_path(upload, index)
+    temp_path = f'{final_path}.{os.getpid()}.tmp'
+
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        with open(temp_path, 'wb') as out:
+            while True:
+                block = stream.read(STREAM_BLOCK_SIZE) if stream else b''
+                if not block:
+                    break
+                written += len(block)
+                if written > expected_size:
+                    raise ChunkError(f'Chunk {index} is larger than {expected_size} bytes.')
+                digest.update(block)
+                out.write(block)
+
+        if written != expected_size:
+            raise ChunkError(f'Chunk {index} has {written} bytes, expected {expected_size}.')
+        if digest.hexdigest() != checksum.lower():
+            raise ChunkError(f'Chunk {index} failed its SHA-256 checksum.')
+
+        os.replace(temp_path, final_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def assemble(upload):
+    """
+    Concatenate every chunk into the final file and remove the chunks.
+    Returns the SHA-256 of the assembled file.
+    """
+    missing = sorted(set(range(upload.total_chunks)) - set(received_chunks(upload)))
+    if missing:
+        raise ChunkError(f'Missing chunks: {", ".join(str(index) for index in missing)}.')
+
+    target = assembled_path(upload)
+    with open(target, 'wb') as out:
+        for index in range(upload.total_chunks):
+            with open(chunk_path(upload, index), 'rb') as part:
+                _copy_file(part, out, upload.chunk_length(index))
+
+    if os.path.getsize(target) != upload.size:
+        os.remove(target)
+        raise ChunkError('Assembled file size does not match the declared size.')
+
+    for index in range(upload.total_chunks):
+        os.remove(chunk_path(upload, index))
+
+    # Chunks may arrive in any order, so the whole-file digest for
+    # content-addressed storage is taken once the file is in one piece.
+    digest = hashlib.sha256()
+    with open(target, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _copy_file(source, target, count):
+    """Append source to target with sendfile where the platform allows it."""
+    offset = 0
+    try:
+        while offset < count:
+            sent = os.sendfile(target.fileno(), source.fileno(), offset, count - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (AttributeError, OSError):
+        if offset:
+            raise
+        # sendfile is unavailable or cannot write to regular files here
+        shutil.copyfileobj(source, target, STREAM_BLOCK_SIZE)
+        target.flush()
+
+
+def delete_upload_files(upload):
+    shutil.rmtree(upload_dir(upload), ignore_errors=True)
+
+
+class AssembledFile(File):
+    """
+    Wraps an assembled upload like a TemporaryUploadedFile, so
+    FileSystemStorage moves it into place instead of copying it.
+    """
+
+    def __init__(self, upload):
+        super().__init__(open(assembled_path(upload), 'rb'), name=upload.filename)
+        self.path = assembled_path(upload)
+        self.content_type = upload.content_type
+        self.sha256 = upload.sha256 or None
+
+    def temporary_file_path(self):
+        return self.path
@@ -9,6 +9,8 @@ from .views import (
     MapLayerViewSet,
     PointOfInterestViewSet,
     SharedMapViewSet,
+    ChunkedUploadViewSet,
+    MediaView,
     SharedWithMeView,
     PublicMapsView,
     MyMapsView
@@ -19,10 +21,12 @@ router.register(r'maps', MapViewSet, basename='map')
 router.register(r'layers', MapLayerViewSet, basename='layer')
 router.register(r'pois', PointOfInterestViewSet, basename='poi')
 router.register(r'shared', SharedMapViewSet, basename='shared')
+router.register(r'uploads', ChunkedUploadViewSet, basename='upload')
 
 urlpatterns = [
     path('', include(router.urls)),
     path('shared-with-me/', SharedWithMeView.as_view(), name='shared-with-me'),
     path('public/', PublicMapsView.as_view(), name='public-maps'),
     path('my-maps/', MyMapsView.as_view(), name='my-maps'),
+    path('media/<path:path>', MediaView.as_view(), name='media'),
 ]
\ No newline at end of file
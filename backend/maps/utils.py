@@ -0,0 +1,17 @@
+"""
+Storage helpers shared by the map file pipelines.
+"""
+
+from django.core.files.storage import default_storage
+
+
+def delete_storage_tree(path):
+    """Recursively delete a directory from default storage."""
+    if not default_storage.exists(path):
+        return
+    directories, files = default_storage.listdir(path)
+    for name in files:
+        default_storage.delete(f'{path}/{name}')
+    for name in directories:
+        delete_storage_tree(f'{path}/{name}')
+    default_storage.delete(path)
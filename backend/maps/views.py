@@ -3,25 +3,73 @@ Views for the maps app.
 Implements full CRUD operations for all map-related models.
 """
 
-from rest_framework import viewsets, generics, status, filters
+import gzip
+import json
+import math
+import mimetypes
+import re
+
+from rest_framework import viewsets, generics, mixins, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
-from django.db.models import Q
+from django.core.cache import cache
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-
-from .models import Map, MapLayer, PointOfInterest, SharedMap
+from django.utils.text import slugify
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+
+from .clusters import CLUSTER_MAX_ZOOM, clusters_for, get_level
+from .display import DISPLAY_CONTENT_TYPE, display_path
+from .filters import BoundingBoxFilter, FullTextSearchFilter
+from .media import REVALIDATE_CACHE_CONTROL, accept_quality, normalized_name, parse_accept, serve_file
+from .models import (
+    DEFAULT_POI_COLOR,
+    Map,
+    MapLayer,
+    PointOfInterest,
+    SharedMap,
+    ChunkedUpload,
+    Tombstone,
+    record_poi_change,
+    with_layer_fields
+)
 from .serializers import (
     MapSerializer,
     MapListSerializer,
     MapUpdateSerializer,
     MapLayerSerializer,
     PointOfInterestSerializer,
+    PointOfInterestBulkSerializer,
     PointOfInterestListSerializer,
+    PointOfInterestNearestSerializer,
     SharedMapSerializer,
-    SharedMapUpdateSerializer
+    SharedMapUpdateSerializer,
+    ChunkedUploadSerializer
 )
+from .pagination import KeysetPagination
+from .pdf import (
+    DEFAULT_PAGE_RESOLUTION,
+    PAGE_CONTENT_TYPE,
+    PAGE_RESOLUTIONS,
+    PdfRenderError,
+    get_page_raster
+)
+from .poi_columns import POI_COLUMNS_CONTENT_TYPE, encode_columns, poi_columns
+from .poi_export import EXPORT_CONTENT_TYPES, export_pois
+from .poi_import import IMPORT_FORMATS, PoiImportError, detect_format, import_rows, read_rows
+from .poi_tiles import POI_TILE_CONTENT_TYPE, POI_TILE_MAX_ZOOM, get_poi_tile, poi_tile_etag
+from .search import AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT, autocomplete
+from .spatial import NEAREST_K, NEAREST_MAX_K, nearest, parse_bbox
+from .thumbnails import THUMBNAIL_SIZES, thumbnail_path
+from .tiles import TILE_CONTENT_TYPE, tile_path
+from .uploads import ChunkError, assemble, received_chunks, write_chunk
 
 
 def get_user_map_permission(user, map_obj):
@@ -57,11 +105,29 @@ class MapViewSet(viewsets.ModelViewSet):
     """
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser, JSONParser]
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = KeysetPagination
+    filter_backends = [filters.OrderingFilter, FullTextSearchFilter]
     search_fields = ['name', 'description']
     ordering_fields = ['name', 'created_at', 'updated_at']
     ordering = ['-updated_at']
 
+    def initialize_request(self, request, *args, **kwargs):
+        drf_request = super().initialize_request(request, *args, **kwargs)
+        if self.action == 'import_pois':
+            # Imports are read as a stream, so spool the file to disk instead
+            # of holding up to FILE_UPLOAD_MAX_MEMORY_SIZE of it in memory
+            request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        return drf_request
+
+    def perform_content_negotiation(self, request, force=False):
+        # Image actions are requested with image/* Accept headers, so fall
+        # back to JSON for their errors instead of answering 406. Exports
+        # and POI lists take ?format=, which DRF would otherwise match
+        # against renderers
+        if self.action in ['image', 'tiles', 'poi_tiles', 'pages', 'export', 'pois']:
+            force = True
+        return super().perform_content_negotiation(request, force)
+
     def get_serializer_class(self):
         if self.action == 'list':
             return MapListSerializer
@@ -76,7 +142,13 @@ class MapViewSet(viewsets.ModelViewSet):
         shared_map_ids = SharedMap.objects.filter(shared_with=user).values_list('map_id', flat=True)
         shared_maps = Map.objects.filter(id__in=shared_map_ids)
         public_maps = Map.objects.filter(is_public=True)
-        return (owned_maps | shared_maps | public_maps).distinct()
+        queryset = (owned_maps | shared_maps | public_maps).distinct()
+        if self.action == 'retrieve':
+            # MapSerializer nests its POIs, with layer fields read in the same query
+            queryset = queryset.prefetch_related(
+                Prefetch('points_of_interest', queryset=with_layer_fields(PointOfInterest.objects.all()))
+            )
+        return queryset
 
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -105,9 +177,12 @@ class MapViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['get'])
     def pois(self, request, pk=None):
-        """Get all POIs for a map with sorting options."""
+        """
+        Get all POIs for a map with sorting options, optionally within ?bbox=x0,y0,x1,y1.
+        ?format=columnar or columnar-binary sends them as columns instead.
+        """
         map_obj = self.get_object()
-        pois = map_obj.points_of_interest.all()
+        pois = BoundingBoxFilter().filter_queryset(request, map_obj.points_of_interest.all(), self)
 
         # Sorting options
         sort_by = request.query_params.get('sort_by', 'created_at')
@@ -122,9 +197,211 @@ class MapViewSet(viewsets.ModelViewSet):
         else:  # created_at
             pois = pois.order_by('created_at' if sort_order == 'asc' else '-created_at')
 
-        serializer = PointOfInterestListSerializer(pois, many=True)
+        output_format = request.query_params.get('format')
+        if output_format == 'columnar':
+            return Response(poi_columns(map_obj, pois))
+        if output_format == 'columnar-binary':
+            return HttpResponse(encode_columns(poi_columns(map_obj, pois)), content_type=POI_COLUMNS_CONTENT_TYPE)
+
+        serializer = PointOfInterestListSerializer(with_layer_fields(pois), many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'], url_path='pois/autocomplete')
+    def autocomplete(self, request, pk=None):
+        """
+        Suggest POIs for a typed ?q=, best matches first: id, name and
+        position only, at most ?limit= of them.
+        """
+        map_obj = self.get_object()
+
+        limit = request.query_params.get('limit', str(AUTOCOMPLETE_LIMIT))
+        if not limit.isdigit() or not 1 <= int(limit) <= AUTOCOMPLETE_MAX_LIMIT:
+            return Response(
+                {"error": f"Limit must be an integer from 1 to {AUTOCOMPLETE_MAX_LIMIT}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response(autocomplete(map_obj, request.query_params.get('q', ''), int(limit)))
+
+    @action(detail=True, methods=['get'], url_path='pois/nearest')
+    def nearest(self, request, pk=None):
+        """
+        Get the ?k= POIs nearest to ?x=&y= (percentages), closest first,
+        optionally only those of ?layer=<id> or ?layer=none.
+        """
+        map_obj = self.get_object()
+
+        k = request.query_params.get('k', str(NEAREST_K))
+        if not k.isdigit() or not 1 <= int(k) <= NEAREST_MAX_K:
+            return Response(
+                {"error": f"k must be an integer from 1 to {NEAREST_MAX_K}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        layer = request.query_params.get('layer')
+        try:
+            x = float(request.query_params['x'])
+            y = float(request.query_params['y'])
+            if not (math.isfinite(x) and math.isfinite(y)):
+                raise ValueError
+            if layer not in (None, 'none'):
+                layer = int(layer)
+        except (KeyError, ValueError):
+            return Response(
+                {"error": "Expected x and y as numbers and layer as a layer ID or 'none'."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        pois = with_layer_fields(map_obj.points_of_interest.all())
+        if layer == 'none':
+            pois = pois.filter(layer__isnull=True)
+        elif layer is not None:
+            pois = pois.filter(layer_id=layer)
+
+        results = nearest(pois, x, y, int(k), map_obj.width, map_obj.height)
+        return Response(PointOfInterestNearestSerializer(results, many=True).data)
+
+    @action(detail=True, methods=['get'])
+    def changes(self, request, pk=None):
+        """
+        Get the layers and POIs changed after ?since=<cursor>, and the IDs
+        of those deleted. Without a cursor, or with one older than the kept
+        tombstones, the full state is returned with reset: true.
+        """
+        map_obj = self.get_object()
+        since = request.query_params.get('since')
+        if since is not None and not since.isdigit():
+            return Response(
+                {"error": "since must be a cursor returned by this endpoint."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # A revision is bumped and its rows written in one transaction that
+        # holds the map row lock, so every change up to the map's current
+        # revision is committed and later ones are left for the next request
+        cursor = map_obj.poi_revision
+        since = None if since is None else int(since)
+        # Rows written before revisions were tracked are at 0, so 0 resets too
+        reset = not since or not map_obj.pruned_revision <= since <= cursor
+        layers = map_obj.layers.filter(revision__lte=cursor)
+        pois = with_layer_fields(map_obj.points_of_interest.filter(revision__lte=cursor))
+        deleted = {'layers': [], 'points_of_interest': []}
+        if not reset:
+            layers = layers.filter(revision__gt=since)
+            pois = pois.filter(revision__gt=since)
+            tombstones = map_obj.tombstones.filter(revision__gt=since, revision__lte=cursor)
+            for kind, object_id in tombstones.values_list('kind', 'object_id'):
+                deleted['layers' if kind == 'layer' else 'points_of_interest'].append(object_id)
+
+        return Response({
+            'cursor': str(cursor),
+            'reset': reset,
+            'layers': MapLayerSerializer(layers, many=True).data,
+            'points_of_interest': PointOfInterestListSerializer(pois, many=True).data,
+            'deleted': deleted,
+        })
+
+    @action(detail=True, methods=['get'])
+    def clusters(self, request, pk=None):
+        """
+        Get POIs clustered for a zoom level (0 to CLUSTER_MAX_ZOOM).
+        Optional filters: ?bbox=x0,y0,x1,y1 and ?layers=1,2,none
+        """
+        map_obj = self.get_object()
+
+        zoom = request.query_params.get('zoom', '0')
+        if not zoom.isdigit() or int(zoom) > CLUSTER_MAX_ZOOM:
+            return Response(
+                {"error": f"Zoom must be an integer from 0 to {CLUSTER_MAX_ZOOM}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        bbox = request.query_params.get('bbox')
+        layers = request.query_params.get('layers')
+        try:
+            bbox = parse_bbox(bbox) if bbox else None
+            if layers is not None:
+                layers = {None if layer == 'none' else int(layer) for layer in layers.split(',') if layer}
+        except ValueError:
+            return Response(
+                {"error": "Expected bbox=x0,y0,x1,y1 and layers as comma-separated layer IDs or 'none'."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        zoom = int(zoom)
+        level = get_level(map_obj, zoom)
+        layer_colors = dict(map_obj.layers.values_list('id', 'color'))
+        return Response({
+            'zoom': zoom,
+            'max_zoom': CLUSTER_MAX_ZOOM,
+            'clusters': clusters_for(level, zoom, layer_colors, DEFAULT_POI_COLOR, bbox, layers),
+        })
+
+    @action(detail=True, methods=['post'], url_path='import', parser_classes=[MultiPartParser, FormParser])
+    def import_pois(self, request, pk=None):
+        """
+        Import POIs from an uploaded CSV or GeoJSON file.
+        Form fields: file, optional file_format (csv, geojson) and columns,
+        a JSON {field: column} mapping. Streams one JSON line per committed
+        batch, then a summary with the created layers and rejected rows.
+        """
+        map_obj = self.get_object()
+        permission = get_user_map_permission(request.user, map_obj)
+        if permission not in ['owner', 'admin', 'edit']:
+            return Response(
+                {"error": "You do not have permission to add points to this map."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "No file provided."}, status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('file_format') or detect_format(upload.name)
+        if file_format not in IMPORT_FORMATS:
+            return Response(
+                {"error": f"Format must be one of: {', '.join(IMPORT_FORMATS)}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            columns = json.loads(request.data.get('columns') or '{}')
+        except ValueError:
+            columns = None
+        if not isinstance(columns, dict):
+            return Response(
+                {"error": "columns must be a JSON object mapping fields to column names."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            rows = read_rows(upload.open('rb'), file_format, columns)
+        except PoiImportError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        lines = (json.dumps(event) + '\n' for event in import_rows(map_obj, request.user, rows))
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+        response['X-Accel-Buffering'] = 'no'  # Let progress lines through nginx as they come
+        return response
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """Download all POIs of a map as ?format=csv (default), geojson or ndjson."""
+        map_obj = self.get_object()
+        export_format = request.query_params.get('format', 'csv')
+        if export_format not in EXPORT_CONTENT_TYPES:
+            return Response(
+                {"error": f"Format must be one of: {', '.join(EXPORT_CONTENT_TYPES)}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        response = StreamingHttpResponse(
+            export_pois(map_obj, export_format),
+            content_type=EXPORT_CONTENT_TYPES[export_format]
+        )
+        filename = f"{slugify(map_obj.name) or 'map'}-pois.{export_format}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
     @action(detail=True, methods=['get'])
     def layers(self, request, pk=None):
         """Get all layers for a map."""
@@ -133,6 +410,106 @@ class MapViewSet(viewsets.ModelViewSet):
         serializer = MapLayerSerializer(layers, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def image(self, request, pk=None):
+        """
+        Get the map image in the variant the Accept header prefers.
+        The WebP display image is sent to clients that list image/webp,
+        the original to everyone else.
+        """
+        map_obj = self.get_object()
+        if map_obj.file_type != 'image':
+            return Response(
+                {"error": "This map is not an image."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        name = map_obj.file.name
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if map_obj.has_display_image:
+            accepted = parse_accept(request.headers.get('Accept'))
+            webp_quality = accepted.get(DISPLAY_CONTENT_TYPE, 0)
+            if webp_quality > 0 and webp_quality >= accept_quality(accepted, content_type):
+                name, content_type = display_path(name), DISPLAY_CONTENT_TYPE
+
+        # The file behind this URL depends on the request, so it is never immutable
+        response = serve_file(request, name, content_type, cache_control=REVALIDATE_CACHE_CONTROL)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    @action(detail=True, methods=['get'], url_path=r'tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)')
+    def tiles(self, request, pk=None, z=None, x=None, y=None):
+        """Get a single tile of the map's deep-zoom pyramid."""
+        map_obj = self.get_object()
+        if map_obj.tile_max_zoom is None:
+            return Response(
+                {"error": "Tiles are not available for this map."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        if int(z) > map_obj.tile_max_zoom:
+            raise Http404("Tile not found.")
+
+        return serve_file(request, tile_path(map_obj, int(z), int(x), int(y)), TILE_CONTENT_TYPE)
+
+    @action(detail=True, methods=['get'], url_path=r'poi-tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)')
+    def poi_tiles(self, request, pk=None, z=None, x=None, y=None):
+        """Get the POIs of one tile, in the binary format described in poi_tiles.py."""
+        map_obj = self.get_object()
+        z, x, y = int(z), int(x), int(y)
+        if z > POI_TILE_MAX_ZOOM or x >= 1 << z or y >= 1 << z:
+            raise Http404("Tile not found.")
+
+        # Tiles are stored gzipped, other clients get them decompressed
+        encodings = parse_accept(request.headers.get('Accept-Encoding'))
+        gzipped = encodings.get('gzip', encodings.get('*', 0)) > 0
+        etag = poi_tile_etag(map_obj)
+        if not gzipped:
+            etag = etag[:-1] + '-identity"'
+
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            response = HttpResponseNotModified()
+        else:
+            data = get_poi_tile(map_obj, z, x, y, DEFAULT_POI_COLOR)
+            response = HttpResponse(data if gzipped else gzip.decompress(data), content_type=POI_TILE_CONTENT_TYPE)
+            if gzipped:
+                response['Content-Encoding'] = 'gzip'
+        response['ETag'] = etag
+        response['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+    @action(detail=True, methods=['get'], url_path=r'pages/(?P<page>\d+)')
+    def pages(self, request, pk=None, page=None):
+        """Get a PDF page rendered to an image, rendering it on first access."""
+        map_obj = self.get_object()
+        if map_obj.page_count is None:
+            return Response(
+                {"error": "This map has no rasterized pages."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        page = int(page)
+        if not 1 <= page <= map_obj.page_count:
+            raise Http404("Page not found.")
+
+        resolution = request.query_params.get('resolution', DEFAULT_PAGE_RESOLUTION)
+        if resolution not in PAGE_RESOLUTIONS:
+            return Response(
+                {"error": f"Resolution must be one of: {', '.join(PAGE_RESOLUTIONS)}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            name = get_page_raster(map_obj, page, resolution)
+        except PdfRenderError:
+            return Response(
+                {"error": "This page could not be rendered."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+
+        return serve_file(request, name, PAGE_CONTENT_TYPE)
+
     @action(detail=True, methods=['get'])
     def user_permission(self, request, pk=None):
         """Get the current user's permission level for this map."""
@@ -254,6 +631,22 @@ class MapLayerViewSet(viewsets.ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
+POI_BULK_MAX_OPERATIONS = 10000
+POI_BULK_BATCH_SIZE = 500
+BY_LAYER_CACHE_TIMEOUT = 60 * 60  # Keyed by map POI revision, so only unused entries expire
+
+
+def _item_errors(serializer, count):
+    """Errors of a many=True serializer as one dict per item, empty for valid items."""
+    if serializer.is_valid():
+        return [{} for _ in range(count)]
+    errors = serializer.errors
+    if isinstance(errors, dict):
+        # Newer DRF versions key the errors of invalid items by index
+        return [dict(errors.get(index, {})) for index in range(count)]
+    return [dict(item) for item in errors]
+
+
 class PointOfInterestViewSet(viewsets.ModelViewSet):
     """
     ViewSet for PointOfInterest model.
@@ -266,7 +659,8 @@ class PointOfInterestViewSet(viewsets.ModelViewSet):
     - view: read only
     """
     permission_classes = [IsAuthenticated]
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = KeysetPagination
+    filter_backends = [filters.OrderingFilter, FullTextSearchFilter, BoundingBoxFilter]
     search_fields = ['name', 'description']
     ordering_fields = ['name', 'created_at', 'updated_at', 'layer__name']
     ordering = ['-created_at']
@@ -297,6 +691,9 @@ class PointOfInterestViewSet(viewsets.ModelViewSet):
         if layer_id:
             queryset = queryset.filter(layer_id=layer_id)
 
+        if self.action == 'list':
+            queryset = with_layer_fields(queryset)
+
         return queryset
 
     def create(self, request, *args, **kwargs):
@@ -341,34 +738,182 @@ class PointOfInterestViewSet(viewsets.ModelViewSet):
 
         return super().create(request, *args, **kwargs)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Create, update and delete many POIs of one map in one transaction.
+        Body: {"map": id, "create": [{...}], "update": [{"id": id, ...}], "delete": [id, ...]}
+        Returns the affected IDs in request order. If any item is invalid,
+        nothing is saved and the errors are listed per item instead.
+        """
+        map_obj = get_object_or_404(Map, id=request.data.get('map'))
+        operations = {key: request.data.get(key, []) for key in ('create', 'update', 'delete')}
+        if not all(isinstance(items, list) for items in operations.values()):
+            return Response(
+                {"error": "create, update and delete must be lists."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if sum(len(items) for items in operations.values()) > POI_BULK_MAX_OPERATIONS:
+            return Response(
+                {"error": f"At most {POI_BULK_MAX_OPERATIONS} operations are allowed per request."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Permission is checked once for the whole request
+        permission = get_user_map_permission(request.user, map_obj)
+        if (operations['create'] or operations['update']) and permission not in ['owner', 'admin', 'edit']:
+            return Response(
+                {"error": "You do not have permission to add or edit points on this map."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        if operations['delete'] and permission not in ['owner', 'admin']:
+            return Response(
+                {"error": "You do not have permission to delete points on this map."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        if not any(operations.values()):
+            return Response({'created': [], 'updated': [], 'deleted': []})
+
+        context = {'request': request, 'layer_ids': set(map_obj.layers.values_list('id', flat=True))}
+        creates = PointOfInterestBulkSerializer(data=operations['create'], many=True, context=context)
+        updates = PointOfInterestBulkSerializer(data=operations['update'], many=True, partial=True, context=context)
+        errors = {
+            'create': _item_errors(creates, len(operations['create'])),
+            'update': _item_errors(updates, len(operations['update'])),
+            'delete': [{} for _ in operations['delete']],
+        }
+        update_ids = [item.get('id') if isinstance(item, dict) else None for item in operations['update']]
+        delete_ids = operations['delete']
+
+        with transaction.atomic():
+            targets = [pk for pk in update_ids + delete_ids if isinstance(pk, int)]
+            existing = map_obj.points_of_interest.select_for_update().in_bulk(targets)
+
+            seen = set()
+            for kind, ids in (('update', update_ids), ('delete', delete_ids)):
+                for index, pk in enumerate(ids):
+                    if not isinstance(pk, int) or pk not in existing:
+                        errors[kind][index]['id'] = ['Point of interest not found on this map.']
+                    elif pk in seen:
+                        errors[kind][index]['id'] = ['Point of interest is listed more than once.']
+                    else:
+                        seen.add(pk)
+
+            if any(any(item_errors) for item_errors in errors.values()):
+                return Response(
+                    {"error": "Some operations are invalid, nothing was saved.", **errors},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # Bulk writes skip save() and its signals, so the whole request
+            # is stamped with one revision and recorded once here
+            revision = Map.bump_poi_revision(map_obj.id)
+
+            created = [
+                PointOfInterest(map=map_obj, created_by=request.user, revision=revision, **data)
+                for data in creates.validated_data
+            ]
+            PointOfInterest.objects.bulk_create(created, batch_size=POI_BULK_BATCH_SIZE)
+
+            updated = [existing[pk] for pk in update_ids]
+            removed = [poi._stored_cluster_entry for poi in updated]
+            fields = {'revision', 'updated_at'}
+            now = timezone.now()
+            for poi, data in zip(updated, updates.validated_data):
+                for field, value in data.items():
+                    setattr(poi, field, value)
+                fields.update(data)
+                poi.revision = revision
+                poi.updated_at = now
+            if updated:
+                PointOfInterest.objects.bulk_update(updated, sorted(fields), batch_size=POI_BULK_BATCH_SIZE)
+
+            removed += [existing[pk]._stored_cluster_entry for pk in delete_ids]
+            if delete_ids:
+                PointOfInterest.objects.filter(pk__in=delete_ids).delete()
+                Tombstone.objects.bulk_create([
+                    Tombstone(map=map_obj, kind='poi', object_id=pk, revision=revision) for pk in delete_ids
+                ])
+
+            added = [(poi.x_position, poi.y_position, poi.layer_id, poi.color) for poi in created + updated]
+            record_poi_change(map_obj.id, removed=removed, added=added, revision=revision)
+
+        return Response({
+            'created': [poi.id for poi in created],
+            'updated': update_ids,
+            'deleted': delete_ids,
+        })
+
     @action(detail=False, methods=['get'])
     def by_layer(self, request):
-        """Get POIs grouped by layer for a specific map."""
+        """
+        Get POIs grouped by layer for a specific map, from one POI query.
+        Cached per map POI revision, which every POI or layer change bumps.
+        With ?layer= only that layer keeps its POIs; every layer is still
+        listed with its full POI count.
+        """
         map_id = request.query_params.get('map', None)
         if not map_id:
             return Response(
                 {"error": "Map ID is required."},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        if not map_id.isdigit():
+            return Response(
+                {"error": "Map ID must be an integer."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        layer_id = request.query_params.get('layer', None)
+        if layer_id and not layer_id.isdigit():
+            return Response(
+                {"error": "Layer ID must be an integer."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        queryset = self.get_queryset().filter(map_id=map_id)
-        layers = MapLayer.objects.filter(map_id=map_id)
-
-        result = []
-        for layer in layers:
-            pois = queryset.filter(layer=layer)
-            result.append({
-                'layer': MapLayerSerializer(layer).data,
-                'points_of_interest': PointOfInterestListSerializer(pois, many=True).data
-            })
+        map_obj = get_object_or_404(Map, id=map_id)
+        if get_user_map_permission(request.user, map_obj) is None:
+            return Response(
+                {"error": "You do not have permission to view this map."},
+                status=status.HTTP_403_FORBIDDEN
+            )
 
-        # Include POIs without a layer
-        no_layer = queryset.filter(layer__isnull=True)
-        if no_layer.exists():
-            result.append({
-                'layer': None,
-                'points_of_interest': PointOfInterestListSerializer(no_layer, many=True).data
-            })
+        key = f'poi-by-layer:{map_obj.pk}:{map_obj.poi_revision}'
+        result = cache.get(key)
+        if result is None:
+            layers = list(map_obj.layers.all())
+            groups = {layer.id: [] for layer in layers}
+            no_layer = []
+            for poi in with_layer_fields(map_obj.points_of_interest.all()):
+                if poi.layer_id is None:
+                    no_layer.append(poi)
+                elif poi.layer_id in groups:
+                    groups[poi.layer_id].append(poi)
+
+            counts = {layer_id: len(pois) for layer_id, pois in groups.items()}
+            layers_data = MapLayerSerializer(layers, many=True, context={'poi_counts': counts}).data
+            result = [
+                {
+                    'layer': layer_data,
+                    'points_of_interest': PointOfInterestListSerializer(groups[layer.id], many=True).data
+                }
+                for layer, layer_data in zip(layers, layers_data)
+            ]
+            # Include POIs without a layer
+            if no_layer:
+                result.append({
+                    'layer': None,
+                    'points_of_interest': PointOfInterestListSerializer(no_layer, many=True).data
+                })
+            cache.set(key, result, BY_LAYER_CACHE_TIMEOUT)
+
+        # Filtered from the cached grouping of the whole map, so one entry
+        # per revision serves every layer
+        if layer_id:
+            result = [
+                {**group, 'points_of_interest': group['points_of_interest'] if group['layer']['id'] == int(layer_id) else []}
+                for group in result if group['layer'] is not None
+            ]
 
         return Response(result)
 
@@ -422,6 +967,138 @@ class SharedMapViewSet(viewsets.ModelViewSet):
         return super().update(request, *args, **kwargs)
 
 
+class ChunkedUploadViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    ViewSet for resumable chunked uploads of large map files.
+    POST /api/maps/uploads/ - start an upload
+    GET /api/maps/uploads/{id}/ - list received chunks, to resume
+    PUT /api/maps/uploads/{id}/chunks/{index}/ - send one chunk (X-Chunk-SHA256 header)
+    POST /api/maps/uploads/{id}/complete/ - assemble the file
+
+    A completed upload is attached by passing its id as upload_id when
+    creating or updating a map.
+    """
+    serializer_class = ChunkedUploadSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return ChunkedUpload.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+    @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>\d+)')
+    def chunks(self, request, pk=None, index=None):
+        """Stream one chunk straight to disk and verify its checksum."""
+        upload = self.get_object()
+        if upload.status != 'uploading':
+            return Response(
+                {"error": "This upload is already complete."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        index = int(index)
+        if index >= upload.total_chunks:
+            return Response(
+                {"error": f"Chunk index must be below {upload.total_chunks}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        checksum = request.headers.get('X-Chunk-SHA256')
+        if not checksum:
+            return Response(
+                {"error": "The X-Chunk-SHA256 header is required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            write_chunk(upload, index, request.stream, checksum)
+        except ChunkError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'index': index, 'received_chunks': received_chunks(upload)})
+
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        """Assemble the received chunks into the final file."""
+        upload = self.get_object()
+        with transaction.atomic():
+            # Locked so that concurrent calls assemble the file only once
+            upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+            if upload.status == 'uploading':
+                try:
+                    upload.sha256 = assemble(upload)
+                except ChunkError as exc:
+                    return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+                upload.status = 'complete'
+                upload.save(update_fields=['sha256', 'status', 'updated_at'])
+
+        return Response(self.get_serializer(upload).data)
+
+
+class MediaView(APIView):
+    """
+    Serve an uploaded file after checking the user can see its map.
+    GET /api/maps/media/<path>
+
+    Supports Range and conditional requests, and hands the transfer to
+    the front web server when MEDIA_OFFLOAD is configured.
+    """
+    permission_classes = [IsAuthenticated]
+
+    DERIVED_MAP_RE = re.compile(r'^maps/user_\d+/(?:tiles|pages)/map_(\d+)/')
+    THUMBNAIL_RE = re.compile(r'^(maps/.+)/thumbnails/(.+)_[a-z]+\.jpg$')
+    DISPLAY_IMAGE_RE = re.compile(r'^(maps/.+)/display/(.+)\.webp$')
+
+    def perform_content_negotiation(self, request, force=False):
+        # Browsers ask for image/* here, so fall back to JSON for errors
+        # instead of answering 406
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request, path):
+        if not self.can_access(request.user, path):
+            raise Http404("File not found.")
+        return serve_file(request, path)
+
+    @staticmethod
+    def derived_names(file_name):
+        """Thumbnail and display image paths made from a map file."""
+        return {display_path(file_name), *(thumbnail_path(file_name, size) for size in THUMBNAIL_SIZES)}
+
+    def can_access(self, user, path):
+        # Prefixes are only meaningful on a path that cannot climb out of them
+        path = normalized_name(path)
+        if path is None:
+            return False
+        if path.startswith('profile_pictures/'):
+            # Avatars are shown next to user names across the app, so any
+            # signed-in user may read them
+            return True
+        if not path.startswith('maps/'):
+            return False
+
+        match = self.DERIVED_MAP_RE.match(path)
+        derivative = self.THUMBNAIL_RE.match(path) or self.DISPLAY_IMAGE_RE.match(path)
+        if match:
+            maps = Map.objects.filter(pk=match.group(1))
+        elif derivative:
+            # Thumbnails and display images belong to every map using the file
+            # they were made from. The prefix also matches files whose stem only
+            # starts the same, so a map must derive exactly this path
+            maps = Map.objects.filter(file__startswith=f'{derivative.group(1)}/{derivative.group(2)}.')
+        else:
+            maps = Map.objects.filter(file=path)
+
+        return any(
+            get_user_map_permission(user, map_obj)
+            for map_obj in maps.select_related('owner')
+            if not derivative or path in self.derived_names(map_obj.file.name)
+        )
+
+
 class SharedWithMeView(generics.ListAPIView):
     """
     List all maps shared with the current user.
@@ -429,6 +1106,7 @@ class SharedWithMeView(generics.ListAPIView):
     """
     serializer_class = MapListSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         shared_map_ids = SharedMap.objects.filter(
@@ -444,6 +1122,7 @@ class PublicMapsView(generics.ListAPIView):
     """
     serializer_class = MapListSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         # Return public maps, excluding the user's own maps
@@ -457,6 +1136,7 @@ class MyMapsView(generics.ListAPIView):
     """
     serializer_class = MapListSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Map.objects.filter(owner=self.request.user)
\ No newline at end of file